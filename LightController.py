@@ -1,211 +1,455 @@
 import pygame
-import broadlink.exceptions
-from time import time, sleep
+from time import time, perf_counter
 import asyncio
+import math
+import random
 
 import xbox360_controller
-from bulb import initialize_connection
-from colors import lamp_colors
+from bulb import initialize_group_connection, AsyncBulb, BulbGroup, BulbTransport
+from bulb_state import BulbState
+from button_mapping import ButtonMapping
+from controller_session import ControllerSession
+from device_cache import DeviceCache
+from command_pipeline import CommandPipeline, INPUT, RAMP, SCENE
+from controller_input import ControllerInput
+from metrics import metrics
+from colors import palettes
+from color_wheel import ColorWheel
+from scene_engine import Scene
+
+CONNECTING = "connecting"
+CONNECTED = "connected"
+RECONNECTING = "reconnecting"
+DISCONNECTED = "disconnected"
+
+# states sent over and over whatever the button mapping is, see preset_states()
+FIXED_STATES = [dict(pwr=0), dict(pwr=1),
+                *(dict(red=red, green=green, blue=blue) for palette in palettes.values() for red, green, blue in palette)]
 
 
 class LightController:
+    scene_frame_rate = 10
+    scene_transition_time = 2.5
     max_bulb_connection_retries = 3
-    bulb_retry_timeout = 10
+    # None keeps reconnecting in the background until the bulb is back
+    max_bulb_reconnection_retries = None
+    reconnect_base_delay = 0.5
+    reconnect_max_delay = 30
+    # how long an action that reads the power or color mode may wait for a stale state to be read back
+    stale_state_refresh_timeout = 0.3
+    # the actions (besides the ones that only run while the bulb is on) that read the shadow state
+    state_reading_actions = ("toggle_power", "toggle_color_mode")
 
     def __init__(self, bulb_ip, ssid, wifi_pass):
-        self.bulb_ip = bulb_ip
+        # a comma separated list of IPs controls a group of bulbs together, "ip:port" for a non default port
+        self.bulb_ips = [ip.strip() for ip in bulb_ip.split(",") if ip.strip()] if bulb_ip else []
         self.ssid = ssid
         self.wifi_pass = wifi_pass
         self.bulb = None
-        self.is_bulb_connected = False
-        self.my_controller = None
-        self.last_timestamp = time()
-        self.currently_held_button = None
-        self.currently_held_button_press_timestamp = None
-        self.wheel_color_loop = None
-        self.is_wheel_color_mode = False
-        self.additive_y = 0
-        self.is_brightness_loop_running = False
-        self.bulb_pwr = None
+        self.bulb_transport = None
+        self.device_cache = DeviceCache()
+        self.connection_health = CONNECTING
+        self.disconnected_at = None
+        self.last_bulb_error = None
+        self.reconnect_task = None
+        # a ControllerSession per connected pad, by joystick instance id
+        self.sessions = {}
+        self.bulb_state = BulbState()
+        self.command_pipeline = CommandPipeline(None, self.bulb_state.sync, self.handle_bulb_timeout)
+        self.controller_input = None
+        self.input_recorder = None
+        self.button_mapping = ButtonMapping()
+        # time from receiving a controller event until it was handled
+        self.input_latency = metrics.histogram("input_handling_seconds", "Time from receiving a controller event until it was handled")
+        self.reconnect_attempts = metrics.counter("bulb_reconnect_attempts_total", "Attempts to reconnect to the bulbs")
+        self.controller_events = {}
+        self.unchanged_ramp_steps = metrics.counter("ramp_steps_unchanged_total",
+                                                    "Ramp ticks that didn't change the bulb state, so nothing was sent")
+        self.ignored_axis_events = metrics.counter("ignored_axis_events_total", "Stick movements that did not change anything")
         self.is_colors_scene_loop_running = False
-        self.connect_to_bulb()
+        self.is_audio_scene_running = False
+        # a WAV file or "-" for raw PCM on stdin, see audio_scene.py
+        self.audio_source = None
+        self.scene_palette_names = list(palettes)
+        self.scene_palette = self.scene_palette_names[0]
+        self.scenes = {}
+        self.color_wheel = ColorWheel()
+
+    @property
+    def is_bulb_connected(self):
+        return self.connection_health == CONNECTED
 
     async def start(self):
-        pygame.init()
+        # connect while pygame starts up on the input reader thread
+        connecting = asyncio.create_task(self.start_bulb_tasks())
+        controller_input = ControllerInput(asyncio.get_running_loop())
+        controller_input.start()
+        if not await connecting:
+            controller_input.stop()
+            return
+        await controller_input.ready
+        self.controller_input = controller_input
+        try:
+            await self.handle_input()
+        finally:
+            # also when start() is cancelled, the recording keeps what was buffered
+            self.controller_input.stop()
+            if self.input_recorder:
+                self.input_recorder.close()
 
-        while self.is_bulb_connected:
-            await asyncio.sleep(0.1)
-            for event in pygame.event.get():
+    async def handle_input(self):
+        # keep handling input while reconnecting, the pipeline holds the resulting state until the bulb is back
+        while self.connection_health != DISCONNECTED:
+            batch = await self.controller_input.get_batch()
+            if not batch:
+                break
+            # a new mapping only takes effect between batches, every event is handled by one of them
+            if self.button_mapping.reload_if_changed() and self.bulb is not None:
+                self.bulb.precache(self.preset_states())
+            if self.is_bulb_connected and self.bulb_state.is_stale():
+                self.refresh_stale_bulb_state()
+            for event, received_at in batch:
+                if self.input_recorder:
+                    self.input_recorder.record(event, received_at)
+                self.count_controller_event(event.type)
                 if event.type == pygame.JOYDEVICEADDED:
-                    self.my_controller = xbox360_controller.Controller(device_id=event.device_index)
-                    print("Detected joystick:", self.my_controller.joystick.get_name(), self.my_controller.joystick.get_guid())
-                if event.type == pygame.JOYDEVICEREMOVED:
+                    controller = xbox360_controller.Controller(device_id=event.device_index)
+                    self.add_controller(controller.joystick.get_instance_id(), controller)
+                    print("Detected joystick:", controller.joystick.get_name(), controller.joystick.get_guid())
+                elif event.type == pygame.JOYDEVICEREMOVED:
+                    self.remove_controller(event.instance_id)
                     print("Joystick disconnected")
-                else:
-                    try:
-                        await self.handle_joystick_controls(event)
-                    except broadlink.exceptions.NetworkTimeoutError:
-                        print("---------------")
-                        print("Bulb connection error, using retry mechanism...")
-                        self.connect_to_bulb()
-
-    async def handle_joystick_controls(self, event):
+                elif getattr(event, "instance_id", None) in self.sessions:
+                    session = self.sessions[event.instance_id]
+                    await self.handle_joystick_controls(event, session, received_at)
+            for session in self.sessions.values():
+                if session.has_axis_moved:
+                    # measured from the oldest event of the batch, the sticks were waiting since then
+                    self.handle_controller_snapshot(session, batch[0][1])
+            handled_at = perf_counter()
+            for _, received_at in batch:
+                self.input_latency.observe(handled_at - received_at)
+
+    async def start_bulb_tasks(self):
+        if not await self.connect_to_bulb(self.max_bulb_connection_retries):
+            return False
+        asyncio.create_task(self.command_pipeline.run())
+        return True
+
+    def add_controller(self, instance_id, controller):
+        session = ControllerSession(instance_id, controller)
+        self.sessions[instance_id] = session
+        return session
+
+    def remove_controller(self, instance_id):
+        session = self.sessions.pop(instance_id, None)
+        if session:
+            session.close()
+
+    def count_controller_event(self, event_type):
+        counter = self.controller_events.get(event_type)
+        if counter is None:
+            counter = metrics.counter("controller_events_total", "Events received from the controllers",
+                                      type=pygame.event.event_name(event_type))
+            self.controller_events[event_type] = counter
+        counter.inc()
+
+    def stop(self):
+        self.connection_health = DISCONNECTED
+        for session in self.sessions.values():
+            session.close()
+        if self.controller_input:
+            self.controller_input.stop()
+
+    async def handle_joystick_controls(self, event, session, received_at=None):
         if event.type == pygame.JOYBUTTONUP:
-            if event.button == self.currently_held_button:
+            if event.button == session.currently_held_button:
                 # use timestamp difference to distinguish between holding and a normal press
-                self.currently_held_button = None
-                if self.is_wheel_color_mode:
-                    print("Stopping wheel color loop")
-                    self.wheel_color_loop.cancel()
-                    self.is_wheel_color_mode = False
+                session.currently_held_button = None
+                if session.is_wheel_color_mode:
+                    print(session, "- stopping wheel color mode")
+                    session.is_wheel_color_mode = False
+                    session.wheel_saturation = 0
+                    return
+            if event.button == session.held_modifier:
+                session.held_modifier = None
+                # it was held for a combo, not pressed on its own
+                if session.is_modifier_used:
                     return
-            bulb_pwr = self.bulb.get_state()['pwr']
-            self.bulb_pwr = bulb_pwr
-            if event.button == xbox360_controller.START:
-                new_pwr = not bulb_pwr
-                self.bulb_pwr = new_pwr
-                self.bulb.set_state(pwr=int(new_pwr))
-            if not self.bulb_pwr:
-                return
-            match event.button:
-                case xbox360_controller.BACK:
-                    bulb_color_mode = self.bulb.get_state()['bulb_colormode']
-                    self.bulb.set_state(bulb_colormode=int(not bulb_color_mode), brightness=50)
-                case xbox360_controller.A:
-                    self.bulb.set_state(red=0, green=100, blue=0)
-                case xbox360_controller.B:
-                    self.bulb.set_state(red=100, green=0, blue=0)
-                case xbox360_controller.X:
-                    self.bulb.set_state(red=0, green=0, blue=100)
-                case xbox360_controller.Y:
-                    self.bulb.set_state(red=255, green=140, blue=0)
-                case xbox360_controller.LEFT_BUMP:
-                    bulb_state = self.bulb.get_state()
-                    state = " - ".join([f"{k}: {bulb_state.get(k)}" for k in ["pwr", "red", "green", "blue", "brightness"]])
-                    print(state)
-                case xbox360_controller.RIGHT_BUMP:
-                    if self.is_colors_scene_loop_running:
-                        print("Stopping colors scene loop")
-                        self.is_colors_scene_loop_running = False
-                    else:
-                        self.is_colors_scene_loop_running = True
-                        asyncio.create_task(self.colors_scene_loop())
+            await self.dispatch(session, event.type, event.button, received_at)
         elif event.type == pygame.JOYBUTTONDOWN:
             if event.button in [xbox360_controller.B, xbox360_controller.A, xbox360_controller.X]:
-                self.currently_held_button = event.button
-                self.currently_held_button_press_timestamp = time()
+                session.currently_held_button = event.button
+                session.currently_held_button_press_timestamp = time()
+            if event.button in self.button_mapping.modifiers:
+                session.held_modifier = event.button
+                session.is_modifier_used = False
         elif event.type == pygame.JOYAXISMOTION:
-            if not self.bulb_pwr:
-                return
-            now = time()
-            # sort of throttling to prevent too much tasks / calculations on short time
-            if (now - self.last_timestamp) < 0.05:
-                return
-            if event.axis in (xbox360_controller.LEFT_STICK_X, xbox360_controller.LEFT_STICK_Y):
-                self.handle_left_joystick(now)
-            elif event.axis in (xbox360_controller.RIGHT_STICK_X, xbox360_controller.RIGHT_STICK_Y):
-                self.handle_right_joystick()
+            # the sticks are read once per batch of events, see handle_controller_snapshot()
+            session.has_axis_moved = True
         elif event.type == pygame.JOYHATMOTION:
-            up, right, down, left = self.my_controller.get_pad()
-            if up:
-                self.bulb.set_state(red=255, green=0, blue=255)
-            if right:
-                self.bulb.set_state(red=75, green=0, blue=130)
-            if down:
-                self.bulb.set_state(red=210, green=105, blue=30)
-            if left:
-                self.bulb.set_state(red=0, green=255, blue=255)
-
-    def handle_left_joystick(self, now):
-        if self.currently_held_button is None:
+            # not kept as the session's controller_state, the sticks of this batch are compared against that one
+            for direction, is_pressed in enumerate(session.controller.snapshot().pad):
+                if is_pressed:
+                    await self.dispatch(session, event.type, direction, received_at)
+
+    async def dispatch(self, session, event_type, code, requested_at=None):
+        steps, is_combo = self.button_mapping.get(event_type, session.held_modifier, code)
+        if steps is None:
             return
-        # check if the button is held enough time (0.2s) and then execute the wheel color task loop
-        if now - self.currently_held_button_press_timestamp > 0.2 and not self.is_wheel_color_mode:
-            self.wheel_color_loop = asyncio.create_task(self.create_wheel_color_loop())
-            self.is_wheel_color_mode = True
-        if not self.is_wheel_color_mode:
+        if is_combo:
+            session.is_modifier_used = True
+        if any(needs_power or method in self.state_reading_actions for method, _, needs_power in steps):
+            await self.wait_for_state_refresh()
+        for method, arguments, needs_power in steps:
+            # read for every step, a macro can turn the bulb on first
+            if needs_power and not self.bulb_state.get('pwr'):
+                continue
+            # the writes are measured from the input, including the wait for the refresh above
+            getattr(self, method)(requested_at=requested_at, **arguments)
+
+    def toggle_power(self, requested_at=None):
+        self.set_bulb_state(requested_at=requested_at, pwr=int(not self.bulb_state.get('pwr')))
+
+    def toggle_color_mode(self, requested_at=None):
+        bulb_color_mode = self.bulb_state.get('bulb_colormode')
+        self.set_bulb_state(requested_at=requested_at, bulb_colormode=int(not bulb_color_mode), brightness=50)
+
+    def print_state(self, requested_at=None):
+        print(self.bulb_state, "-", self.command_pipeline, "- queued commands:", self.bulb.queue_depth)
+        print("Input latency:", self.input_latency, "- press to command latency:", self.command_pipeline.command_latency)
+        print(self.bulb)
+
+    def toggle_scene(self, requested_at=None):
+        if self.is_colors_scene_loop_running:
+            print("Stopping colors scene loop")
+            self.is_colors_scene_loop_running = False
+        else:
+            self.is_audio_scene_running = False
+            self.is_colors_scene_loop_running = True
+            asyncio.create_task(self.colors_scene_loop())
+
+    def toggle_audio_scene(self, requested_at=None):
+        if self.is_audio_scene_running:
+            print("Stopping audio scene")
+            self.is_audio_scene_running = False
+        elif not self.audio_source:
+            print("No audio source, set AUDIO_SOURCE to a WAV file or - for PCM on stdin")
+        else:
+            self.is_colors_scene_loop_running = False
+            self.is_audio_scene_running = True
+            asyncio.create_task(self.audio_scene_loop())
+
+    def next_palette(self, requested_at=None):
+        next_index = (self.scene_palette_names.index(self.scene_palette) + 1) % len(self.scene_palette_names)
+        self.scene_palette = self.scene_palette_names[next_index]
+        print("Scene palette:", self.scene_palette)
+
+    def handle_controller_snapshot(self, session, received_at=None):
+        session.has_axis_moved = False
+        state = session.controller.snapshot()
+        changes = state.changes(session.controller_state)
+        session.controller_state = state
+        if not self.bulb_state.get('pwr'):
+            self.ignored_axis_events.inc()
             return
-        # only if got here calculate the new value
-        _, left_y = self.my_controller.get_left_stick()
-        self.additive_y = (-1 * left_y) * 15
-        self.last_timestamp = now
-
-    def handle_right_joystick(self):
-        if not self.is_brightness_loop_running:
-            asyncio.create_task(self.create_brightness_loop())
-            self.is_brightness_loop_running = True
-        _, right_y = self.my_controller.get_right_stick()
-        self.additive_y = (-1 * right_y) * 10
-
-    async def create_wheel_color_loop(self):
-        print("Starting wheel color loop")
-        while True:
-            await asyncio.sleep(0.1)
-            bulb_state = self.bulb.get_state()
-            if self.currently_held_button == xbox360_controller.B:
-                red = int(bulb_state['red'] + self.additive_y)
-                if red > 255:
-                    red = 255
-                if red < 1:
-                    red = 1
-                self.bulb.set_state(red=red)
-            if self.currently_held_button == xbox360_controller.A:
-                green = int(bulb_state['green'] + self.additive_y)
-                if green > 255:
-                    green = 255
-                if green < 1:
-                    green = 1
-                self.bulb.set_state(green=green)
-            if self.currently_held_button == xbox360_controller.X:
-                blue = int(bulb_state['blue'] + self.additive_y)
-                if blue > 255:
-                    blue = 255
-                if blue < 1:
-                    blue = 1
-                self.bulb.set_state(blue=blue)
-
-    async def create_brightness_loop(self):
-        print("Starting brightness loop")
-        executed_at = time()
-        # loop for 15 seconds
-        while time() - executed_at < 15 and self.bulb_pwr:
+        # no throttling needed here, the command pipeline merges the resulting writes
+        if "left_stick" in changes:
+            self.handle_left_joystick(session, time(), state.left_stick, received_at)
+        if "right_stick" in changes:
+            self.handle_right_joystick(session, state.right_stick)
+
+    def handle_left_joystick(self, session, now, left_stick, received_at=None):
+        if session.currently_held_button is None:
+            self.ignored_axis_events.inc()
+            return
+        # check if the button is held enough time (0.2s) and then switch to the wheel color mode
+        if now - session.currently_held_button_press_timestamp > 0.2 and not session.is_wheel_color_mode:
+            print(session, "- starting wheel color mode")
+            session.is_wheel_color_mode = True
+        if not session.is_wheel_color_mode:
+            return
+        x, y = left_stick
+        magnitude = min(math.hypot(x, y), 1)
+        if not magnitude:
+            # back in the dead zone, the picked color stays
+            session.wheel_saturation = 0
+            return
+        # a released stick springs back through paler colors and a noisy angle, so the saturation only follows
+        # the stick outwards and positions that close to the center are not used at all
+        if magnitude < session.wheel_saturation / 2:
+            self.ignored_axis_events.inc()
+            return
+        session.wheel_saturation = max(session.wheel_saturation, magnitude)
+        red, green, blue = self.color_wheel.lookup(x, -y, session.wheel_saturation)
+        if (red, green, blue) == (self.bulb_state['red'], self.bulb_state['green'], self.bulb_state['blue']):
+            self.ignored_axis_events.inc()
+            return
+        self.set_bulb_state(requested_at=received_at, red=red, green=green, blue=blue)
+
+    def handle_right_joystick(self, session, right_stick):
+        _, right_y = right_stick
+        session.right_stick_y = -1 * right_y
+        if session.right_stick_y and not session.is_brightness_loop_running:
+            session.brightness_loop = asyncio.create_task(self.create_brightness_loop(session))
+            session.is_brightness_loop_running = True
+
+    async def create_brightness_loop(self, session):
+        print(session, "- starting brightness loop")
+        # ends as soon as the stick is back in its dead zone, nothing runs while the pad is left alone
+        while self.bulb_state.get('pwr'):
             await asyncio.sleep(0.1)
-            brightness = int(self.bulb.get_state()['brightness'] + self.additive_y)
-            if brightness > 100:
-                brightness = 100
-            if brightness < 1:
-                brightness = 1
-            self.bulb.set_state(brightness=brightness)
-        self.is_brightness_loop_running = False
-        print("Stopped running brightness loop")
+            step = session.brightness_axis.process(session.right_stick_y)
+            if not session.right_stick_y:
+                break
+            self.ramp_bulb_state('brightness', step, 100)
+        session.brightness_axis.process(0)
+        session.is_brightness_loop_running = False
+        print(session, "- stopped running brightness loop")
+
+    def ramp_bulb_state(self, key, step, highest):
+        value = min(max(self.bulb_state[key] + step, 1), highest)
+        # a stick held at a limit (or let go) keeps asking for the current value, there is nothing to send then
+        if value == self.bulb_state[key]:
+            self.unchanged_ramp_steps.inc()
+            return
+        self.set_bulb_state(priority=RAMP, **{key: value})
 
     async def colors_scene_loop(self):
-        print("Starting colors scene loop")
         while self.is_colors_scene_loop_running:
-            for color in lamp_colors:
-                if not self.is_colors_scene_loop_running:
-                    break
-                self.bulb.set_state(red=color[0], green=color[1], blue=color[2])
-                await asyncio.sleep(2.5)
-
-    def connect_to_bulb(self):
-        max_retries = self.max_bulb_connection_retries
-        while max_retries > 0:
-            if max_retries != self.max_bulb_connection_retries:
+            scene = self.get_scene(self.scene_palette)
+            print("Starting colors scene loop:", scene.name)
+            # switching the palette ends this scene, the loop then continues with the new one
+            await scene.play(self.set_scene_frame,
+                             lambda: self.is_colors_scene_loop_running and self.scene_palette == scene.name)
+
+    async def audio_scene_loop(self):
+        try:
+            # numpy is only needed for this scene
+            from audio_scene import AudioScene
+        except ImportError as e:
+            print("The audio scene needs numpy:", e)
+            self.is_audio_scene_running = False
+            return
+        print("Starting audio scene:", self.audio_source)
+        try:
+            await AudioScene(self.audio_source).play(self.set_audio_frame, lambda: self.is_audio_scene_running)
+        except (OSError, ValueError) as e:
+            print("Could not play audio:", e)
+        self.is_audio_scene_running = False
+        print("Stopped audio scene")
+
+    def get_scene(self, palette_name):
+        key = (palette_name, self.scene_frame_rate, self.scene_transition_time)
+        if key not in self.scenes:
+            self.scenes[key] = Scene(palette_name, palettes[palette_name], self.scene_frame_rate, self.scene_transition_time)
+        return self.scenes[key]
+
+    def set_scene_frame(self, red, green, blue):
+        # a slow bulb gets only the newest frame, the pipeline replaces frames it didn't send yet
+        # and drops the ones that waited for longer than two frames
+        self.set_bulb_state(priority=SCENE, max_age=2 / self.scene_frame_rate, red=red, green=green, blue=blue)
+
+    def set_audio_frame(self, red, green, blue, brightness):
+        from audio_scene import AudioScene
+
+        # like scene frames, a frame the bulb didn't take within two frames is dropped
+        self.set_bulb_state(priority=SCENE, max_age=2 / AudioScene.frame_rate, red=red, green=green, blue=blue,
+                            brightness=brightness)
+
+    def set_bulb_state(self, priority=INPUT, max_age=None, requested_at=None, **changes):
+        # update the shadow state first so reads made while the packet is in flight see the new value
+        self.bulb_state.update(**changes)
+        # requested_at is when the input behind the change was received, the command latency is measured from it
+        self.command_pipeline.set_state(priority, requested_at, max_age, **changes)
+
+    def handle_bulb_timeout(self):
+        if not self.is_bulb_connected:
+            return
+        self.connection_health = RECONNECTING
+        self.disconnected_at = time()
+        self.command_pipeline.pause()
+        print("---------------")
+        print("Bulb connection error, reconnecting in the background...")
+        self.reconnect_task = asyncio.create_task(self.reconnect_to_bulb())
+
+    async def reconnect_to_bulb(self):
+        if not await self.connect_to_bulb(self.max_bulb_reconnection_retries, is_reconnect=True):
+            self.controller_input.stop()
+
+    def refresh_stale_bulb_state(self):
+        # changes made outside of this program (app, wall switch) are picked up on the first input after a quiet
+        # period, instead of polling the bulb while nobody uses the pad. The read goes through the pipeline
+        # behind any pending write, only actions that read the state wait for it (see dispatch())
+        self.bulb_state.postpone_refresh()
+        self.command_pipeline.request_refresh()
+
+    async def wait_for_state_refresh(self):
+        try:
+            await asyncio.wait_for(self.command_pipeline.refreshed.wait(), self.stale_state_refresh_timeout)
+        except asyncio.TimeoutError:
+            # go on with the shadow state, the refresh still lands once the bulb answers
+            pass
+
+    async def connect_to_bulb(self, max_retries, is_reconnect=False):
+        attempt = 0
+        while max_retries is None or attempt < max_retries:
+            if attempt or is_reconnect:
+                delay = self.get_reconnect_delay(attempt)
                 print("---------------")
-                print(f"Trying to re-connect to smart bulb in {self.bulb_retry_timeout} seconds...")
-                sleep(self.bulb_retry_timeout)
+                print(f"Trying to re-connect to smart bulb in {delay:.1f} seconds...")
+                await asyncio.sleep(delay)
+            attempt += 1
+            if is_reconnect:
+                self.reconnect_attempts.inc()
             try:
-                self.bulb = initialize_connection(self.bulb_ip, self.ssid, self.wifi_pass)
-                self.is_bulb_connected = True
-                self.bulb_pwr = self.bulb.get_state()['pwr']
-                print("---------------")
-                print("Smart bulb detected, model:", self.bulb.type)
-                return None
-            except Exception:
-                max_retries -= 1
-                print(f"Attempt number {self.max_bulb_connection_retries - max_retries} - error above ^^")
+                connecting_at = perf_counter()
+                # discovery and auth are blocking, run them off the event loop so input keeps flowing
+                devices, bulb_state = await asyncio.to_thread(self.open_bulb_connection)
+            except Exception as e:
+                self.last_bulb_error = e
+                print(f"Attempt number {attempt} - error: {e!r}")
+                continue
+            self.bulb_state.sync(bulb_state)
+            # what was pressed during the outage is still pending, it wins over the state read from the bulb
+            self.bulb_state.update(**self.command_pipeline.pending_changes)
+            if self.bulb_transport is None:
+                self.bulb_transport = await BulbTransport.open()
+            if self.bulb is not None:
+                self.bulb.close()
+            self.bulb = BulbGroup([AsyncBulb(device, self.bulb_transport, self.preset_states()) for device in devices])
+            self.connection_health = CONNECTED
+            self.command_pipeline.resume(self.bulb)
+            print("---------------")
+            print(f"Smart bulbs detected: {len(self.bulb)}, model:", self.bulb.type)
+            print(f"Connected in {(perf_counter() - connecting_at) * 1000:.0f}ms")
+            if self.disconnected_at is not None:
+                print(f"Bulb was unreachable for {time() - self.disconnected_at:.1f}s")
+                self.disconnected_at = None
+            return True
 
-        self.is_bulb_connected = False
+        self.connection_health = DISCONNECTED
         print("---------------")
-        print(f"Could not connect to smart bulb after {self.max_bulb_connection_retries} retries, finishing program...")
\ No newline at end of file
+        print(f"Could not connect to smart bulb after {attempt} retries, finishing program...")
+        return False
+
+    def preset_states(self):
+        """
+        Returns:
+            The states whose packets are encrypted ahead of time for every connected
+            bulb: power, the scene palettes and what the loaded button mapping sets.
+        """
+
+        return [*FIXED_STATES, *self.button_mapping.states()]
+
+    def open_bulb_connection(self):
+        devices, state = initialize_group_connection(self.bulb_ips, self.ssid, self.wifi_pass,
+                                                     device_cache=self.device_cache)
+        # a reconnected bulb may have been changed or power cycled meanwhile, so resync the whole state (a cached
+        # bulb was just read while its session was checked)
+        return devices, state if state is not None else devices[0].get_state()
+
+    def get_reconnect_delay(self, attempt):
+        delay = min(self.reconnect_base_delay * 2 ** attempt, self.reconnect_max_delay)
+        # jitter keeps several controllers from hitting a recovering network at the same moment
+        return random.uniform(delay / 2, delay)
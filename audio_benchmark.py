@@ -0,0 +1,109 @@
+"""
+Measures the audio scene on synthetic music (a kick drum, a bass line and hi-hats):
+how much faster than real time the analysis runs, the time per block, and the
+memory it keeps and allocates on the way. Then plays it in real time against an
+emulated bulb and reports the frames sent, replaced or dropped by the command
+pipeline and the audio blocks skipped.
+
+    python audio_benchmark.py --seconds 60 --play-seconds 10 --rtt 0.1
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import tracemalloc
+import wave
+from time import perf_counter
+
+import numpy as np
+
+import emulator
+from audio_scene import AudioAnalyzer, AudioScene, AudioSource
+from device_cache import DeviceCache
+from LightController import LightController
+from metrics import Histogram
+
+
+def write_test_wav(path, seconds, sample_rate=44100):
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    beat = t % 0.5
+    kick = np.sin(2 * np.pi * 55 * t) * np.exp(-beat * 20)
+    bass = np.sin(2 * np.pi * np.where(t % 4 < 2, 110, 147) * t) * 0.3
+    hats = np.random.default_rng(0).standard_normal(len(t)) * np.exp(-(t % 0.25) * 60) * 0.2
+    samples = ((kick + bass + hats) * 9000).astype(np.int16)
+    with wave.open(path, "wb") as f:
+        f.setnchannels(2)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(np.repeat(samples, 2).tobytes())
+
+
+def measure_analysis(path):
+    source = AudioSource.open(path)
+    analyzer = AudioAnalyzer(source.sample_rate, source.channels)
+    block_time = Histogram("audio_block_seconds", "")
+    samples = 0
+    tracemalloc.start()
+    # the first blocks warm up numpy's caches
+    for _ in range(10):
+        samples += source.read_into(analyzer.block)
+        analyzer.process()
+    memory_before, _ = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    started_at = perf_counter()
+    while frames := source.read_into(analyzer.block):
+        samples += frames
+        analyzed_at = perf_counter()
+        analyzer.process()
+        block_time.observe(perf_counter() - analyzed_at)
+        analyzer.color()
+    duration = perf_counter() - started_at
+    memory_after, memory_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    source.close()
+    return samples / source.sample_rate / duration, block_time, memory_after - memory_before, memory_peak - memory_before
+
+
+async def measure_playback(path, seconds, rtt):
+    bulbs = emulator.start_bulbs_in_thread(1, rtt=rtt)
+    light_controller = LightController(bulbs[0].address, None, None)
+    light_controller.device_cache = DeviceCache(os.path.join(tempfile.mkdtemp(), "device_cache.json"))
+    if not await light_controller.start_bulb_tasks():
+        return None
+    scene = AudioScene(path)
+    started_at = perf_counter()
+    packets = bulbs[0].received_packets
+    pipeline = light_controller.command_pipeline
+    merged_writes, dropped_writes = pipeline.merged_writes.value, pipeline.dropped_writes.value
+    await scene.play(light_controller.set_audio_frame, lambda: perf_counter() - started_at < seconds)
+    duration = perf_counter() - started_at
+    return (scene, (bulbs[0].received_packets - packets) / duration, pipeline.merged_writes.value - merged_writes,
+            pipeline.dropped_writes.value - dropped_writes)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Benchmark the audio scene on synthetic music")
+    parser.add_argument("--seconds", type=float, default=60, help="length of the audio analyzed as fast as possible")
+    parser.add_argument("--play-seconds", type=float, default=10, help="how long to play it against an emulated bulb")
+    parser.add_argument("--rtt", type=float, default=0.03)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), "test.wav")
+    write_test_wav(path, max(args.seconds, args.play_seconds))
+    speed, block_time, memory_growth, memory_peak = measure_analysis(path)
+    playback = await measure_playback(path, args.play_seconds, args.rtt)
+
+    print("===============")
+    print(f"Analysis: {speed:.0f}x real time at 44.1kHz - block of {AudioAnalyzer.block_size} frames: {block_time}")
+    print(f"Memory while analyzing: {memory_growth} bytes kept - {memory_peak} bytes peak")
+    if playback is None:
+        print("Could not connect to the emulated bulb")
+        return
+    scene, packet_rate, merged_writes, dropped_writes = playback
+    print(f"Playback at {AudioScene.frame_rate} fps, rtt {args.rtt * 1000:.0f}ms: {scene.played_frames.value} frames - "
+          f"{merged_writes} replaced by a newer one and {dropped_writes} dropped by the pipeline - "
+          f"{scene.dropped_blocks.value} audio blocks skipped - {packet_rate:.1f} packets/s")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,216 @@
+"""
+A scene that follows music: 16 bit PCM from a WAV file or a raw stream on stdin
+is split into bass, mids and highs, which drive the red, green and blue of the
+bulb, and the loudest of them its brightness.
+
+    ffmpeg -re -i song.mp3 -f s16le -ar 44100 -ac 2 - | AUDIO_SOURCE=- python main.py
+
+Every buffer is allocated up front, analyzing a block allocates nothing that
+grows with the block size.
+"""
+import asyncio
+import sys
+import wave
+from time import perf_counter
+
+import numpy as np
+
+from metrics import metrics
+
+# frequency ranges (Hz) of the bands that drive red, green and blue
+BANDS = ((20, 250), (250, 2000), (2000, 8000))
+
+
+class AudioSource:
+    """
+    Reads PCM blocks of a WAV file, or of raw 16 bit little endian PCM from stdin.
+    """
+    stdin_sample_rate = 44100
+    stdin_channels = 2
+
+    def __init__(self, file, sample_rate, channels, is_file):
+        self.file = file
+        self.sample_rate = sample_rate
+        self.channels = channels
+        # only a file can skip what the analysis fell behind on, stdin is read in order
+        self.is_file = is_file
+
+    @classmethod
+    def open(cls, path):
+        if path == "-":
+            return cls(sys.stdin.buffer, cls.stdin_sample_rate, cls.stdin_channels, is_file=False)
+        file = open(path, "rb")
+        try:
+            # leaves the file at the start of the samples, and open since wave didn't open it
+            params = wave.open(file).getparams()
+            if params.sampwidth != 2:
+                raise ValueError(f"{params.sampwidth * 8} bit samples")
+        except (wave.Error, EOFError, ValueError) as e:
+            file.close()
+            raise ValueError(f"{path} is not a 16 bit PCM WAV file ({str(e) or 'too short'})")
+        return cls(file, params.framerate, params.nchannels, is_file=True)
+
+    def read_into(self, block):
+        """
+        Fills the int16 (frames, channels) block, blocking until it is full (a pipe
+        returns what it has) or the input ends.
+
+        Returns:
+            The number of frames read, 0 at the end of the input.
+        """
+
+        view = memoryview(block).cast("B")
+        read = 0
+        while read < len(view):
+            count = self.file.readinto(view[read:])
+            if not count:
+                break
+            read += count
+        frames = read // (self.channels * 2)
+        if frames < len(block):
+            # silence after the end of the input, a partial frame is dropped
+            block[frames:] = 0
+        return frames
+
+    def skip(self, frames):
+        self.file.seek(frames * self.channels * 2, 1)
+
+    def close(self):
+        if self.is_file:
+            self.file.close()
+
+
+class AudioAnalyzer:
+    """
+    Keeps the last fft_size samples in a ring buffer and turns them into a color
+    after every block. Each band is measured against its own recent peak, so quiet
+    and loud music both use the full range, and its level rises fast and falls
+    slowly so beats flash and fade.
+    """
+    block_size = 1024
+    fft_size = 2048
+    # how much of its peak a band keeps per block, it forgets a loud part after a few seconds
+    peak_decay = 0.995
+    attack = 0.7
+    release = 0.15
+    min_brightness = 10
+
+    def __init__(self, sample_rate, channels):
+        self.block = np.zeros((self.block_size, channels), np.int16)
+        # float64 throughout, numpy's FFT would convert float32 input into a new array on every call
+        self.samples = np.zeros((self.block_size, channels))
+        self.ring = np.zeros(self.fft_size)
+        self.slots = self.fft_size // self.block_size
+        self.slot = 0
+        # the ring is not rotated into time order, the window is rotated to match instead: after writing a slot the
+        # oldest sample is at the start of the next one. The magnitudes of the FFT don't depend on the rotation.
+        window = np.hanning(self.fft_size)
+        self.windows = [np.roll(window, (slot + 1) % self.slots * self.block_size) for slot in range(self.slots)]
+        self.weighted = np.zeros(self.fft_size)
+        self.spectrum = np.zeros(self.fft_size // 2 + 1, np.complex128)
+        self.power = np.zeros(self.fft_size // 2 + 1)
+        frequencies = np.fft.rfftfreq(self.fft_size, 1 / sample_rate)
+        # summing the bins of each band is a single matrix product
+        self.band_matrix = np.array([(frequencies >= low) & (frequencies < high) for low, high in BANDS], float)
+        self.energies = np.zeros(len(BANDS))
+        self.peaks = np.full(len(BANDS), 1e-3)
+        self.levels = np.zeros(len(BANDS))
+        self.targets = np.zeros(len(BANDS))
+        self.rates = np.zeros(len(BANDS))
+
+    def process(self):
+        """
+        Adds self.block (filled by AudioSource.read_into()) to the ring buffer and
+        updates the band levels.
+        """
+
+        # the channels are summed, not averaged, the levels are relative to each band's peak anyway
+        np.copyto(self.samples, self.block)
+        start = self.slot * self.block_size
+        np.sum(self.samples, axis=1, out=self.ring[start:start + self.block_size])
+        np.multiply(self.ring, self.windows[self.slot], out=self.weighted)
+        self.slot = (self.slot + 1) % self.slots
+        np.fft.rfft(self.weighted, out=self.spectrum)
+        np.abs(self.spectrum, out=self.power)
+        np.square(self.power, out=self.power)
+        np.dot(self.band_matrix, self.power, out=self.energies)
+        np.sqrt(self.energies, out=self.energies)
+
+        np.multiply(self.peaks, self.peak_decay, out=self.peaks)
+        np.maximum(self.peaks, self.energies, out=self.peaks)
+        np.divide(self.energies, self.peaks, out=self.targets)
+        # attack where the level rises, release where it falls
+        np.greater(self.targets, self.levels, out=self.rates)
+        np.multiply(self.rates, self.attack - self.release, out=self.rates)
+        np.add(self.rates, self.release, out=self.rates)
+        np.subtract(self.targets, self.levels, out=self.targets)
+        np.multiply(self.targets, self.rates, out=self.targets)
+        np.add(self.levels, self.targets, out=self.levels)
+
+    def color(self):
+        """
+        Returns:
+            (red, green, blue, brightness) of the current levels.
+        """
+
+        levels = self.levels.tolist()
+        red, green, blue = (round(level * 255) for level in levels)
+        brightness = round(self.min_brightness + (100 - self.min_brightness) * max(levels))
+        return red, green, blue, brightness
+
+
+class AudioScene:
+    """
+    Plays an audio source through AudioAnalyzer and sends a frame frame_rate times
+    per second of audio. The audio is analyzed along with the time it would play
+    for, when the analysis of a file falls behind the blocks that are already over
+    are skipped.
+    Frames the bulb can't take in time are dropped by the command pipeline.
+    """
+    frame_rate = 20
+
+    def __init__(self, path):
+        self.path = path
+        self.played_frames = metrics.counter("audio_frames_played_total", "Audio scene frames sent to the bulb")
+        self.dropped_blocks = metrics.counter("audio_blocks_dropped_total",
+                                              "Audio blocks skipped because the analysis fell behind")
+        self.block_time = metrics.histogram("audio_block_seconds", "Time to analyze a block of audio")
+
+    async def play(self, send_frame, is_running):
+        loop = asyncio.get_running_loop()
+        source = AudioSource.open(self.path)
+        analyzer = AudioAnalyzer(source.sample_rate, source.channels)
+        samples_per_frame = source.sample_rate / self.frame_rate
+        next_frame_at = 0
+        samples = 0
+        last_frame = None
+        started_at = perf_counter()
+        try:
+            while is_running():
+                if source.is_file:
+                    late_blocks = int((perf_counter() - started_at) * source.sample_rate - samples) // analyzer.block_size
+                    if late_blocks > 1:
+                        source.skip(late_blocks * analyzer.block_size)
+                        samples += late_blocks * analyzer.block_size
+                        self.dropped_blocks.inc(late_blocks)
+                # reading stdin blocks until the data is there
+                frames = await loop.run_in_executor(None, source.read_into, analyzer.block)
+                if not frames:
+                    break
+                samples += frames
+                # the block is analyzed once it has been played, stdin that comes in faster than real time
+                # (ffmpeg without -re) waits in the pipe instead of flashing through the song
+                await asyncio.sleep(max(started_at + samples / source.sample_rate - perf_counter(), 0))
+                analyzed_at = perf_counter()
+                analyzer.process()
+                self.block_time.observe(perf_counter() - analyzed_at)
+                if samples < next_frame_at:
+                    continue
+                next_frame_at += samples_per_frame
+                frame = analyzer.color()
+                if frame != last_frame:
+                    send_frame(*frame)
+                    self.played_frames.inc()
+                    last_frame = frame
+        finally:
+            source.close()
@@ -0,0 +1,41 @@
+import math
+
+
+class AxisFilter:
+    """
+    Turns a dead zone adjusted stick value into a whole number of steps per tick,
+    the finest change the bulb can show (1 brightness or color unit).
+
+    The value goes through a response curve (fine control near the center, full
+    speed at the edge), a low-pass filter, and hysteresis so a noisy stick doesn't
+    flip between two steps.
+    """
+    curve_exponent = 1.5
+    # fraction of the distance to the new value covered per tick, 1 disables the filter
+    smoothing = 0.6
+    # how far (in steps) past the halfway point the filtered value has to move before the output changes
+    hysteresis = 0.2
+
+    def __init__(self, max_step):
+        self.max_step = max_step
+        self.filtered = 0.0
+        self.step = 0
+
+    def process(self, value):
+        """
+        Called once per tick with the current stick value.
+
+        Returns:
+            The number of steps to move by, -max_step <= step <= max_step.
+        """
+
+        if value == 0:
+            # letting go of the stick stops the ramp right away
+            self.filtered = 0.0
+            self.step = 0
+            return 0
+        target = math.copysign(abs(value) ** self.curve_exponent, value) * self.max_step
+        self.filtered += (target - self.filtered) * self.smoothing
+        if abs(self.filtered - self.step) > 0.5 + self.hysteresis:
+            self.step = round(self.filtered)
+        return self.step
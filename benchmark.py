@@ -0,0 +1,243 @@
+"""
+Drives LightController against emulated bulbs with synthetic controller events and
+reports press-to-packet latency, packets per second while circling the color wheel
+and during brightness ramps, scene frame lateness and drops, reconnect time, and
+the CPU and packets spent while nobody touches the pad.
+
+    python benchmark.py --bulbs 10 --rtt 0.05 --jitter 0.02 --loss 0.01
+"""
+import argparse
+import asyncio
+import math
+import os
+import tempfile
+from time import perf_counter, process_time
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+
+import pygame
+
+import emulator
+import xbox360_controller
+from device_cache import DeviceCache
+from metrics import Histogram
+from button_mapping import BUTTON_COLORS
+from controller_input import ControllerInput
+from LightController import LightController
+
+
+class SyntheticController:
+    """
+    Stands in for xbox360_controller.Controller, reporting whatever stick and pad
+    positions the benchmark sets.
+    """
+
+    def __init__(self):
+        self.left_stick = (0, 0)
+        self.right_stick = (0, 0)
+        self.pad = (0, 0, 0, 0)
+
+    def get_left_stick(self):
+        return self.left_stick
+
+    def get_right_stick(self):
+        return self.right_stick
+
+    def get_pad(self):
+        return self.pad
+
+    def snapshot(self):
+        buttons = (0,) * len(xbox360_controller.SNAPSHOT_BUTTONS)
+        return xbox360_controller.ControllerState(buttons, self.left_stick, self.right_stick, 0.0, self.pad)
+
+
+def post(event_type, **attributes):
+    pygame.event.post(pygame.event.Event(event_type, instance_id=0, **attributes))
+    return perf_counter()
+
+
+def writes_since(bulb, since, field=None, expected=None):
+    return [write for write in bulb.writes if write[0] >= since and (field is None or field in write[1])
+            and (expected is None or expected.items() <= write[1].items())]
+
+
+async def wait_for(condition, timeout):
+    deadline = perf_counter() + timeout
+    while not condition():
+        if perf_counter() > deadline:
+            return False
+        await asyncio.sleep(0.001)
+    return True
+
+
+async def measure_press_latency(bulbs, presses, timeout):
+    latency = Histogram("press_to_packet_seconds", "Time from a button press until the bulb received the packet")
+    buttons = [xbox360_controller.A, xbox360_controller.B, xbox360_controller.X, xbox360_controller.Y]
+    for i in range(presses):
+        button = buttons[i % len(buttons)]
+        pressed_at = post(pygame.JOYBUTTONUP, button=button)
+        # only the packet with the button's color counts, a running scene keeps writing other colors
+        color = BUTTON_COLORS[button]
+        # a group command is done once the slowest bulb received it
+        if await wait_for(lambda: all(writes_since(bulb, pressed_at, expected=color) for bulb in bulbs), timeout):
+            latency.observe(max(writes_since(bulb, pressed_at, expected=color)[0][0] for bulb in bulbs) - pressed_at)
+        await asyncio.sleep(0.05)
+    return latency
+
+
+async def measure_wheel(bulbs, controller, duration, event_rate=100, turn_time=2):
+    post(pygame.JOYBUTTONDOWN, button=xbox360_controller.B)
+    # holding the button long enough switches to the wheel color mode
+    await asyncio.sleep(0.3)
+    started_at = perf_counter()
+    events = 0
+    # circle the stick around the edge of the wheel
+    while (elapsed := perf_counter() - started_at) < duration:
+        angle = elapsed / turn_time * math.tau
+        controller.left_stick = (math.cos(angle), -math.sin(angle))
+        post(pygame.JOYAXISMOTION, axis=xbox360_controller.LEFT_STICK_X, value=controller.left_stick[0])
+        events += 1
+        await asyncio.sleep(1 / event_rate)
+    packets = len(writes_since(bulbs[0], started_at))
+    controller.left_stick = (0, 0)
+    post(pygame.JOYAXISMOTION, axis=xbox360_controller.LEFT_STICK_X, value=0.0)
+    post(pygame.JOYBUTTONUP, button=xbox360_controller.B)
+    await asyncio.sleep(0.2)
+    return events / duration, packets / duration
+
+
+async def measure_ramp(bulbs, controller, duration, event_rate=100):
+    controller.right_stick = (0, -1)
+    started_at = perf_counter()
+    events = 0
+    while perf_counter() - started_at < duration:
+        post(pygame.JOYAXISMOTION, axis=xbox360_controller.RIGHT_STICK_Y, value=-1.0)
+        events += 1
+        await asyncio.sleep(1 / event_rate)
+    packets = len(writes_since(bulbs[0], started_at))
+    controller.right_stick = (0, 0)
+    post(pygame.JOYAXISMOTION, axis=xbox360_controller.RIGHT_STICK_Y, value=0.0)
+    await asyncio.sleep(0.2)
+    return events / duration, packets / duration
+
+
+async def measure_scene(light_controller, bulbs, duration, frame_rate, presses):
+    bulb = bulbs[0]
+    light_controller.scene_frame_rate = frame_rate
+    scene = light_controller.get_scene(light_controller.scene_palette)
+    started_at = post(pygame.JOYBUTTONUP, button=xbox360_controller.RIGHT_BUMP)
+    await asyncio.sleep(duration)
+    # button presses go ahead of the scene frames
+    press_latency = await measure_press_latency(bulbs, presses, timeout=5)
+    duration = perf_counter() - started_at
+    post(pygame.JOYBUTTONUP, button=xbox360_controller.RIGHT_BUMP)
+    # other loops may still be writing brightness, only the color writes belong to the scene
+    packets = len(writes_since(bulb, started_at, "red"))
+    await asyncio.sleep(0.3)
+    return scene, packets / duration, press_latency
+
+
+async def measure_reconnect(light_controller, bulbs, outage, timeout):
+    loss = [bulb.loss for bulb in bulbs]
+    for bulb in bulbs:
+        bulb.loss = 1.0
+    pressed_at = post(pygame.JOYBUTTONUP, button=xbox360_controller.A)
+    detected = await wait_for(lambda: not light_controller.is_bulb_connected, timeout)
+    detected_at = perf_counter()
+    await asyncio.sleep(outage)
+    for bulb, bulb_loss in zip(bulbs, loss):
+        bulb.loss = bulb_loss
+    restored_at = perf_counter()
+    reconnected = await wait_for(lambda: light_controller.is_bulb_connected, timeout)
+    if not detected or not reconnected:
+        return None, None
+    return detected_at - pressed_at, perf_counter() - restored_at
+
+
+async def measure_idle_press_latency(light_controller, bulbs, presses, timeout):
+    # the first press after the pad was left alone, when an idle reader polls instead of waiting
+    latency = Histogram("idle_press_to_packet_seconds", "Time from the first press after a pause until the packet")
+    for i in range(presses):
+        # spread the presses over the poll interval
+        await asyncio.sleep(light_controller.controller_input.idle_after + 0.5 + i * 0.037)
+        button = xbox360_controller.A if i % 2 else xbox360_controller.B
+        pressed_at = post(pygame.JOYBUTTONUP, button=button)
+        color = BUTTON_COLORS[button]
+        if await wait_for(lambda: all(writes_since(bulb, pressed_at, expected=color) for bulb in bulbs), timeout):
+            latency.observe(max(writes_since(bulb, pressed_at, expected=color)[0][0] for bulb in bulbs) - pressed_at)
+    return latency
+
+
+async def measure_idle(light_controller, bulbs, duration):
+    # wait until the input reader went idle (when it polls) and the last ramp loop ended
+    await asyncio.sleep(light_controller.controller_input.idle_after + 0.5)
+    packets = sum(bulb.received_packets for bulb in bulbs)
+    started_at, cpu_started_at = perf_counter(), process_time()
+    await asyncio.sleep(duration)
+    cpu = process_time() - cpu_started_at
+    duration = perf_counter() - started_at
+    return cpu / duration, (sum(bulb.received_packets for bulb in bulbs) - packets) / duration
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Benchmark LightController against emulated bulbs")
+    parser.add_argument("--bulbs", type=int, default=1)
+    parser.add_argument("--rtt", type=float, default=0.03)
+    parser.add_argument("--jitter", type=float, default=0.01)
+    parser.add_argument("--loss", type=float, default=0.0)
+    parser.add_argument("--presses", type=int, default=100)
+    parser.add_argument("--ramp-duration", type=float, default=3)
+    parser.add_argument("--scene-duration", type=float, default=3)
+    parser.add_argument("--scene-frame-rate", type=int, default=20)
+    parser.add_argument("--outage", type=float, default=2)
+    parser.add_argument("--idle-duration", type=float, default=10)
+    parser.add_argument("--idle-presses", type=int, default=3, help="presses after a pause, each waits for idle first")
+    parser.add_argument("--idle-poll-interval", type=float, default=None,
+                        help="ControllerInput.idle_poll_interval, by default the reader never polls")
+    args = parser.parse_args()
+    ControllerInput.idle_poll_interval = args.idle_poll_interval
+
+    bulbs = emulator.start_bulbs_in_thread(args.bulbs, rtt=args.rtt, jitter=args.jitter, loss=args.loss)
+    light_controller = LightController(",".join(bulb.address for bulb in bulbs), None, None)
+    light_controller.device_cache = DeviceCache(os.path.join(tempfile.mkdtemp(), "device_cache.json"))
+    controller = SyntheticController()
+    light_controller.add_controller(0, controller)
+    running = asyncio.create_task(light_controller.start())
+    if not await wait_for(lambda: light_controller.is_bulb_connected, 30):
+        print("Could not connect to the emulated bulbs")
+        return
+    # let the input reader start before posting events
+    await asyncio.sleep(0.2)
+
+    press_latency = await measure_press_latency(bulbs, args.presses, timeout=5)
+    wheel_event_rate, wheel_packet_rate = await measure_wheel(bulbs, controller, args.ramp_duration)
+    brightness_event_rate, brightness_packet_rate = await measure_ramp(bulbs, controller, args.ramp_duration)
+    scene, scene_packet_rate, scene_press_latency = await measure_scene(light_controller, bulbs, args.scene_duration,
+                                                                        args.scene_frame_rate, args.presses // 4)
+    detection_time, reconnect_time = await measure_reconnect(light_controller, bulbs, args.outage, timeout=60)
+    idle_cpu, idle_packet_rate = await measure_idle(light_controller, bulbs, args.idle_duration)
+    idle_press_latency = await measure_idle_press_latency(light_controller, bulbs, args.idle_presses, timeout=5)
+
+    print("===============")
+    print(f"Bulbs: {args.bulbs} - rtt: {args.rtt * 1000:.0f}ms - jitter: {args.jitter * 1000:.0f}ms - loss: {args.loss:.0%}")
+    print(f"Press to packet latency ({press_latency.count} presses): {press_latency}")
+    print(f"Color wheel: {wheel_event_rate:.0f} events/s -> {wheel_packet_rate:.1f} packets/s")
+    print(f"Brightness ramp: {brightness_event_rate:.0f} events/s -> {brightness_packet_rate:.1f} packets/s")
+    print(f"Scene at {args.scene_frame_rate} fps: frame lateness {scene.frame_lateness} - "
+          f"{scene.played_frames.value} played / {scene.dropped_frames.value} dropped - {scene_packet_rate:.1f} packets/s")
+    print(f"Press to packet latency during the scene ({scene_press_latency.count} presses): {scene_press_latency}")
+    if reconnect_time is not None:
+        print(f"Outage detected after {detection_time:.2f}s - reconnected {reconnect_time:.2f}s after the bulbs came back")
+    else:
+        print("Reconnect did not complete")
+    poll = f"polling every {args.idle_poll_interval * 1000:.0f}ms" if args.idle_poll_interval else "waiting"
+    print(f"Idle ({poll}): {idle_cpu:.2%} CPU - {idle_packet_rate:.2f} packets/s")
+    print(f"First press after a pause ({idle_press_latency.count} presses): {idle_press_latency}")
+
+    light_controller.stop()
+    await running
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
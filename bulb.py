@@ -1,35 +1,430 @@
-import broadlink
-from broadlink.exceptions import NetworkTimeoutError
 import socket
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
+from time import perf_counter
+
+from metrics import metrics
+from packet_cache import PacketCache, COMMAND, READ, check_response
 
 TIMEOUT = 3
+# same as broadlink.const.DEFAULT_PORT. broadlink (and the crypto it loads) is only
+# imported once a bulb is contacted, which happens off the event loop
+DEFAULT_PORT = 80
 
 
-def initialize_connection(bulb_ip, ssid, wifi_password, timeout=TIMEOUT):
-    found_device = None
-    if bulb_ip:
-        try:
-            device = broadlink.hello(bulb_ip, timeout=timeout)
-            found_device = device
-        except Exception as e:
-            print(e)
-            print("Could not establish direct connection, initializing scan...")
-    if not found_device:
-        if not ssid or not wifi_password:
+def initialize_connection(bulb_ip, ssid, wifi_password, timeout=TIMEOUT, device_cache=None):
+    devices, _ = initialize_group_connection([bulb_ip] if bulb_ip else [], ssid, wifi_password, timeout, device_cache)
+    return devices[0]
+
+
+def initialize_group_connection(bulb_ips, ssid, wifi_password, timeout=TIMEOUT, device_cache=None):
+    """
+    Returns:
+        (devices, state of the first device or None). The state is what a cached
+        device answered when its session was checked, it doesn't need to be read
+        again.
+    """
+
+    if device_cache is not None:
+        devices, states = restore_cached_bulbs(bulb_ips, device_cache, timeout)
+        restored_ips = {bulb_address(device) for device in devices}
+        missing_ips = [bulb_ip for bulb_ip in bulb_ips if bulb_ip not in restored_ips]
+        # without IPs every cached bulb has to answer, otherwise the scan can't be limited to the missing ones
+        if devices and not missing_ips and (bulb_ips or len(devices) == len(device_cache.entries)):
+            return devices, states[0]
+        if devices and missing_ips:
+            try:
+                devices += discover_group(missing_ips, ssid, wifi_password, timeout)
+            except Exception as e:
+                print("Could not connect to", ", ".join(missing_ips) + ":", e)
+            device_cache.store(devices)
+            return devices, states[0]
+    devices = discover_group(bulb_ips, ssid, wifi_password, timeout)
+    if device_cache is not None:
+        device_cache.store(devices)
+    return devices, None
+
+
+def restore_cached_bulbs(bulb_ips, device_cache, timeout=TIMEOUT):
+    """
+    Checks the cached session of every bulb with a get_state, all at the same
+    time. A bulb that doesn't answer (new IP, it was reset) is left out.
+
+    Returns:
+        (devices that answered, their states).
+    """
+
+    devices = device_cache.restore(bulb_ips)
+    if not devices:
+        return [], []
+    for device in devices:
+        device.timeout = timeout
+    with ThreadPoolExecutor(max_workers=len(devices)) as executor:
+        states = list(executor.map(read_bulb_state, devices))
+    for device, state in zip(devices, states):
+        if state is None:
+            print(f"Cached bulb {bulb_address(device)} is not responding")
+    answered = [(device, state) for device, state in zip(devices, states) if state is not None]
+    return [device for device, _ in answered], [state for _, state in answered]
+
+
+def read_bulb_state(device):
+    try:
+        return device.get_state()
+    except Exception:
+        return None
+
+
+def discover_group(bulb_ips, ssid, wifi_password, timeout=TIMEOUT):
+    found_devices = {}
+    # talk to all the bulbs at the same time, so a group connects as fast as its slowest bulb
+    with ThreadPoolExecutor(max_workers=max(len(bulb_ips), 1)) as executor:
+        for bulb_ip, device in zip(bulb_ips, executor.map(hello_bulb, bulb_ips, repeat(timeout))):
+            if device:
+                found_devices[bulb_ip] = device
+    missing_ips = [bulb_ip for bulb_ip in bulb_ips if bulb_ip not in found_devices]
+    if missing_ips or not bulb_ips:
+        if missing_ips:
+            print("Could not establish direct connection to", ", ".join(missing_ips))
+        if ssid and wifi_password:
+            print("Initializing scan...")
+            for device in discover_bulbs(ssid, wifi_password, timeout):
+                if not bulb_ips or bulb_address(device) in missing_ips:
+                    found_devices[bulb_address(device)] = device
+        elif found_devices:
+            # no scan without the Wifi credentials, the group runs with the bulbs that answered
+            print("Missing SSID or Wifi password, skipping the scan")
+        else:
+            from broadlink.exceptions import NetworkTimeoutError
+
             raise NetworkTimeoutError("Missing SSID or Wifi password")
-        broadlink.setup(ssid, wifi_password, 3)
-        # find devices - get the first if few were found
-        ip = socket.gethostbyname(socket.gethostname())
-        devices = broadlink.xdiscover(local_ip_address=ip, timeout=timeout)
-        for device in devices:
-            if device.name == 'Smart Bulb':
-                found_device = device
-    if not found_device:
+    if not found_devices:
         raise ConnectionError("Device not found")
 
-    if found_device.is_locked:
-        print("Device is in locked mode, make sure to unlock it")
-        raise ConnectionError("Device is locked")
+    with ThreadPoolExecutor(max_workers=len(found_devices)) as executor:
+        devices = [device for device in executor.map(authenticate_bulb, found_devices.values(), repeat(timeout)) if device]
+    if not devices:
+        raise ConnectionError("Could not authenticate any device")
+    return devices
+
+
+def parse_bulb_address(bulb_address):
+    # "ip" or "ip:port", a port is only needed for bulbs that don't listen on the default one (e.g. the emulator)
+    host, _, port = bulb_address.partition(":")
+    return host, int(port) if port else DEFAULT_PORT
+
+
+def bulb_address(device):
+    host, port = device.host[:2]
+    return host if port == DEFAULT_PORT else f"{host}:{port}"
+
+
+def hello_bulb(bulb_ip, timeout=TIMEOUT):
+    import broadlink
+
+    host, port = parse_bulb_address(bulb_ip)
+    try:
+        return broadlink.hello(host, port=port, timeout=timeout)
+    except Exception as e:
+        print(e)
+        return None
+
+
+def discover_bulbs(ssid, wifi_password, timeout=TIMEOUT):
+    import broadlink
+    from broadlink.exceptions import NetworkTimeoutError
+
+    if not ssid or not wifi_password:
+        raise NetworkTimeoutError("Missing SSID or Wifi password")
+    broadlink.setup(ssid, wifi_password, 3)
+    ip = socket.gethostbyname(socket.gethostname())
+    devices = broadlink.xdiscover(local_ip_address=ip, timeout=timeout)
+    return [device for device in devices if device.name == 'Smart Bulb']
+
+
+def authenticate_bulb(device, timeout=TIMEOUT):
+    if device.is_locked:
+        print(f"Device {bulb_address(device)} is in locked mode, make sure to unlock it")
+        return None
+    device.timeout = timeout
+    try:
+        device.auth()
+    except Exception as e:
+        print(f"Could not authenticate device {bulb_address(device)}:", e)
+        return None
+    return device
+
+
+class BulbTransport(asyncio.DatagramProtocol):
+    """
+    One UDP socket for all the bulbs. Replies are matched to their request by the
+    bulb address and the packet counter, so any number of requests (to one or many
+    bulbs) can be in flight at once, each with its own timeout.
+    """
+    def __init__(self):
+        self.transport = None
+        self.requests = {}
+
+    @classmethod
+    async def open(cls):
+        _, protocol = await asyncio.get_running_loop().create_datagram_endpoint(cls, local_addr=("0.0.0.0", 0))
+        return protocol
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, address):
+        # anything that isn't an answer to a pending request (e.g. a late duplicate) is dropped
+        future = self.requests.get((address[:2], int.from_bytes(data[0x28:0x2A], "little")))
+        if future is not None and not future.done():
+            future.set_result(data)
+
+    def error_received(self, exc):
+        # e.g. ICMP port unreachable, the request times out like a lost packet would
+        pass
+
+    async def request(self, address, count, packet, timeout, retry_interval):
+        """
+        Sends the packet and resends it when no answer came within retry_interval,
+        doubling the interval after every resend, until timeout.
+
+        Returns:
+            (response packet, how many times the packet was sent).
+        """
+
+        from broadlink.exceptions import NetworkTimeoutError
+
+        loop = asyncio.get_running_loop()
+        key = (address, count)
+        future = self.requests[key] = loop.create_future()
+        deadline = loop.time() + timeout
+        sends = 0
+        try:
+            while True:
+                self.transport.sendto(packet, address)
+                sends += 1
+                try:
+                    response = await asyncio.wait_for(asyncio.shield(future), min(retry_interval, deadline - loop.time()))
+                    return response, sends
+                except asyncio.TimeoutError:
+                    if loop.time() >= deadline:
+                        raise NetworkTimeoutError(-4000, "Network timeout",
+                                                  f"No response received within {timeout}s") from None
+                retry_interval *= 2
+        finally:
+            del self.requests[key]
+
+    def close(self):
+        self.transport.close()
+
+
+class RttEstimator:
+    """
+    Smoothed round trip time and variance of one bulb, TCP style (RFC 6298). The
+    retransmission timeout derived from them is how long a request waits for an
+    answer before it is sent again.
+    """
+    min_timeout = 0.05
+    # also the timeout until the first round trip was measured
+    max_timeout = 1
+
+    def __init__(self):
+        self.smoothed_rtt = None
+        self.rtt_variance = None
+
+    @property
+    def timeout(self):
+        if self.smoothed_rtt is None:
+            return self.max_timeout
+        return min(max(self.smoothed_rtt + 4 * self.rtt_variance, self.min_timeout), self.max_timeout)
+
+    def observe(self, rtt):
+        if self.smoothed_rtt is None:
+            self.smoothed_rtt = rtt
+            self.rtt_variance = rtt / 2
+        else:
+            self.rtt_variance = 0.75 * self.rtt_variance + 0.25 * abs(self.smoothed_rtt - rtt)
+            self.smoothed_rtt = 0.875 * self.smoothed_rtt + 0.125 * rtt
+
+
+class AsyncBulb:
+    """
+    Awaitable client for a connected LB1 bulb. Commands go out over the shared
+    BulbTransport without blocking the loop, several of them can be in flight.
+
+    A lost packet is resent after the bulb's adaptive retransmission timeout
+    (both commands are idempotent, they read or set absolute values). A command
+    only fails once the bulb stayed silent for the whole device timeout.
+    """
+    max_queue_size = 16
+
+    def __init__(self, device, transport, preset_states=()):
+        self.device = device
+        self.transport = transport
+        self.type = device.type
+        self.host = bulb_address(device)
+        # set_state payloads are encrypted once per state and session, warmed up with the presets
+        self.packets = PacketCache(device, self.host)
+        self.packets.precache(preset_states)
+        self.command_latency = {command: metrics.histogram("bulb_command_seconds", "Round trip time of bulb commands",
+                                                           bulb=self.host, command=command)
+                                for command in ("get_state", "set_state")}
+        self.rtt = RttEstimator()
+        self.resends = metrics.counter("bulb_packets_resent_total", "Packets sent again after no answer came in time",
+                                       bulb=self.host)
+        self.timeouts = metrics.counter("bulb_timeouts_total", "Bulb commands that timed out", bulb=self.host)
+        self.errors = metrics.counter("bulb_errors_total", "Bulb commands that failed for any reason", bulb=self.host)
+        self.is_responding = True
+        self.queue_slots = None
+        self.pending = 0
+
+    @property
+    def queue_depth(self):
+        return self.pending
+
+    async def get_state(self):
+        return await self.request("get_state", self.packets.get_payload({}, flag=READ))
+
+    async def set_state(self, **changes):
+        return await self.request("set_state", self.packets.get_payload(changes))
+
+    async def request(self, command, payload):
+        if self.queue_slots is None:
+            self.queue_slots = asyncio.Semaphore(self.max_queue_size)
+        # wait for a free slot instead of piling up requests the bulb can't keep up with
+        async with self.queue_slots:
+            self.pending += 1
+            submitted_at = perf_counter()
+            try:
+                count, packet = self.packets.build_packet(COMMAND, payload)
+                response, sends = await self.transport.request(self.device.host, count, packet, self.device.timeout,
+                                                               self.rtt.timeout)
+                check_response(response)
+                state = self.device._decode(response)
+            except Exception as e:
+                from broadlink.exceptions import NetworkTimeoutError
+
+                self.errors.inc()
+                if isinstance(e, NetworkTimeoutError):
+                    self.timeouts.inc()
+                if self.is_responding:
+                    print(f"Bulb {self.host} stopped responding")
+                self.is_responding = False
+                raise
+            finally:
+                self.pending -= 1
+            rtt = perf_counter() - submitted_at
+            self.command_latency[command].observe(rtt)
+            self.resends.inc(sends - 1)
+            # a resent packet can't tell which copy was answered, only clean round trips are measured (Karn)
+            if sends == 1:
+                self.rtt.observe(rtt)
+            if not self.is_responding:
+                print(f"Bulb {self.host} is responding again")
+            self.is_responding = True
+            return state
+
+    def __str__(self):
+        return (f"{self.host} - latency {self.command_latency['set_state']} - "
+                f"retransmission timeout: {self.rtt.timeout * 1000:.0f}ms - resent: {self.resends.value} - "
+                f"failures: {self.errors.value}")
+
+
+class BulbGroup:
+    """
+    Fans every command out to all of its bulbs concurrently. A bulb that fails
+    doesn't fail the group, only a command that no bulb answered raises.
+
+    Commands only wait for the bulbs that are responding. A bulb that stopped
+    responding is caught up in the background instead: the changes it missed are
+    merged and resent one request at a time until it answers again (it is
+    authenticated again if it answers with an error), so one dead bulb doesn't
+    slow down the rest of the room.
+    """
+    # pause between attempts to reach a bulb that stopped responding
+    probe_interval = 5
+
+    def __init__(self, bulbs):
+        self.bulbs = bulbs
+        self.type = ", ".join(sorted({bulb.type for bulb in bulbs}))
+        # bulb -> changes it missed while it was not responding, and the task resending them
+        self.missed_changes = {}
+        self.catch_up_tasks = {}
+
+    @property
+    def queue_depth(self):
+        return max(bulb.queue_depth for bulb in self.bulbs)
+
+    async def get_state(self):
+        return await self.fan_out("get_state")
+
+    async def set_state(self, **changes):
+        return await self.fan_out("set_state", **changes)
+
+    async def fan_out(self, method, **kwargs):
+        responding = [bulb for bulb in self.bulbs if bulb.is_responding]
+        if not responding:
+            # nobody to wait for, let the caller see the failure (and reconnect)
+            responding = self.bulbs
+        for bulb in self.bulbs:
+            if bulb not in responding:
+                self.catch_up(bulb, kwargs)
+        results = await asyncio.gather(*[getattr(bulb, method)(**kwargs) for bulb in responding], return_exceptions=True)
+        states = [result for result in results if not isinstance(result, BaseException)]
+        if not states:
+            from broadlink.exceptions import NetworkTimeoutError
+
+            # prefer a timeout so the caller's reconnect handling kicks in
+            raise next((e for e in results if isinstance(e, NetworkTimeoutError)), results[0])
+        # the command went through, a bulb that failed it gets it later instead of the caller retrying
+        for bulb, result in zip(responding, results):
+            if isinstance(result, BaseException):
+                self.catch_up(bulb, kwargs)
+        return states[0]
+
+    def precache(self, states):
+        for bulb in self.bulbs:
+            bulb.packets.precache(states)
+
+    def close(self):
+        # a replaced group must not keep probing its bulbs and send them what they missed long ago
+        for task in self.catch_up_tasks.values():
+            task.cancel()
+        self.catch_up_tasks.clear()
+        self.missed_changes.clear()
+
+    def catch_up(self, bulb, changes):
+        self.missed_changes[bulb] = {**self.missed_changes.get(bulb, {}), **changes}
+        if bulb not in self.catch_up_tasks:
+            self.catch_up_tasks[bulb] = asyncio.create_task(self.run_catch_up(bulb))
+
+    async def run_catch_up(self, bulb):
+        from broadlink.exceptions import BroadlinkException, NetworkTimeoutError
+
+        try:
+            while True:
+                changes = self.missed_changes.pop(bulb, {})
+                try:
+                    if changes:
+                        await bulb.set_state(**changes)
+                    else:
+                        await bulb.get_state()
+                except BroadlinkException as e:
+                    # newer changes that came in meanwhile win
+                    self.missed_changes[bulb] = {**changes, **self.missed_changes.get(bulb, {})}
+                    if not isinstance(e, NetworkTimeoutError):
+                        # it answered but rejected the session (e.g. it was power cycled)
+                        await asyncio.to_thread(authenticate_bulb, bulb.device, bulb.device.timeout)
+                    await asyncio.sleep(self.probe_interval)
+                    continue
+                if not self.missed_changes.get(bulb):
+                    return
+        finally:
+            self.catch_up_tasks.pop(bulb, None)
+
+    def __len__(self):
+        return len(self.bulbs)
 
-    found_device.auth()
-    return found_device
+    def __str__(self):
+        return "\n".join(str(bulb) for bulb in self.bulbs)
@@ -0,0 +1,71 @@
+from time import time
+
+TRACKED_KEYS = ("pwr", "red", "green", "blue", "brightness", "bulb_colormode")
+# what the mapping and remote clients may set, and the valid range of each value
+STATE_RANGES = {
+    "pwr": (0, 1),
+    "red": (0, 255),
+    "green": (0, 255),
+    "blue": (0, 255),
+    "brightness": (0, 100),
+    "colortemp": (2700, 6500),
+    "bulb_colormode": (0, 2),
+}
+
+
+def check_changes(changes):
+    """
+    Returns:
+        The changes with their values as ints, raises ValueError if they aren't
+        valid bulb state changes.
+    """
+
+    if not isinstance(changes, dict) or not changes:
+        raise ValueError("Expected a JSON object of changes")
+    for key, value in changes.items():
+        if key not in STATE_RANGES:
+            raise ValueError(f"Unknown key {key!r}, expected one of {', '.join(STATE_RANGES)}")
+        low, high = STATE_RANGES[key]
+        # JSON true/false only make sense for the power
+        is_number = isinstance(value, int) and (key == "pwr" or not isinstance(value, bool))
+        if not is_number or not low <= value <= high:
+            raise ValueError(f"{key} must be a whole number from {low} to {high}")
+        changes[key] = int(value)
+    return changes
+
+
+class BulbState:
+    """
+    Local shadow of the bulb state. Updated optimistically from our own writes and
+    synced from full get_state responses, so reads never need a network round trip.
+    """
+    refresh_interval = 30
+
+    def __init__(self):
+        self.state = {}
+        self.synced_at = None
+
+    def sync(self, bulb_state):
+        self.state = {key: bulb_state.get(key) for key in TRACKED_KEYS}
+        self.synced_at = time()
+
+    def update(self, **changes):
+        for key, value in changes.items():
+            if key in TRACKED_KEYS:
+                self.state[key] = value
+
+    def postpone_refresh(self):
+        # the bulb could not be read, try again after another interval instead of on every input
+        self.synced_at = time()
+
+    def is_stale(self):
+        return self.synced_at is None or time() - self.synced_at > self.refresh_interval
+
+    def get(self, key, default=None):
+        return self.state.get(key, default)
+
+    def __getitem__(self, key):
+        return self.state[key]
+
+    def __str__(self):
+        return " - ".join([f"{k}: {self.state.get(k)}" for k in ["pwr", "red", "green", "blue", "brightness"]])
@@ -0,0 +1,237 @@
+"""
+Maps controller buttons, pad directions and button combos to actions, preset
+colors and macros. The mapping can be loaded from a JSON file:
+
+    {
+        "presets": {"green": {"red": 0, "green": 100, "blue": 0}},
+        "macros": {"reading": ["toggle_color_mode", {"brightness": 80}]},
+        "buttons": {"START": "toggle_power", "A": "green"},
+        "pad": {"UP": {"red": 255, "green": 0, "blue": 255}},
+        "combos": {"LEFT_BUMP+A": "reading"}
+    }
+
+A binding names an action, a preset or a macro, or holds the state to set itself.
+States may only hold the keys the remote control accepts, within the same ranges.
+A macro runs its steps in order. A combo fires when the second button is released
+while the first one is held, the first button then does nothing on its own release.
+
+    python button_mapping.py button_mapping.json
+
+writes the built-in mapping, a starting point for a custom one.
+"""
+import argparse
+import json
+import os
+from time import time
+
+import pygame
+
+import xbox360_controller
+from bulb_state import check_changes
+
+BUTTON_COLORS = {
+    xbox360_controller.A: dict(red=0, green=100, blue=0),
+    xbox360_controller.B: dict(red=100, green=0, blue=0),
+    xbox360_controller.X: dict(red=0, green=0, blue=100),
+    xbox360_controller.Y: dict(red=255, green=140, blue=0),
+}
+# up, right, down, left
+PAD_COLORS = (
+    dict(red=255, green=0, blue=255),
+    dict(red=75, green=0, blue=130),
+    dict(red=210, green=105, blue=30),
+    dict(red=0, green=255, blue=255),
+)
+
+BUTTON_NAMES = ("A", "B", "X", "Y", "LEFT_BUMP", "RIGHT_BUMP", "BACK", "START", "LEFT_STICK_BTN", "RIGHT_STICK_BTN")
+# in the order of Controller.get_pad()
+PAD_DIRECTIONS = ("UP", "RIGHT", "DOWN", "LEFT")
+# LightController methods a binding can name (called with requested_at, when the input was received), and whether
+# they only run while the bulb is on
+ACTIONS = {
+    "toggle_power": False,
+    "toggle_color_mode": True,
+    "print_state": True,
+    "toggle_scene": True,
+    "next_palette": True,
+    "toggle_audio_scene": True,
+}
+
+DEFAULT_MAPPING = {
+    "presets": {
+        "green": BUTTON_COLORS[xbox360_controller.A],
+        "red": BUTTON_COLORS[xbox360_controller.B],
+        "blue": BUTTON_COLORS[xbox360_controller.X],
+        "gold": BUTTON_COLORS[xbox360_controller.Y],
+        "magenta": PAD_COLORS[0],
+        "indigo": PAD_COLORS[1],
+        "chocolate": PAD_COLORS[2],
+        "cyan": PAD_COLORS[3],
+    },
+    "macros": {},
+    "buttons": {
+        "START": "toggle_power",
+        "BACK": "toggle_color_mode",
+        "A": "green",
+        "B": "red",
+        "X": "blue",
+        "Y": "gold",
+        "LEFT_BUMP": "print_state",
+        "RIGHT_BUMP": "toggle_scene",
+        "RIGHT_STICK_BTN": "next_palette",
+        "LEFT_STICK_BTN": "toggle_audio_scene",
+    },
+    "pad": {"UP": "magenta", "RIGHT": "indigo", "DOWN": "chocolate", "LEFT": "cyan"},
+    "combos": {},
+}
+
+
+def parse_button(name):
+    if name not in BUTTON_NAMES:
+        raise ValueError(f"Unknown button {name!r}, expected one of {', '.join(BUTTON_NAMES)}")
+    return getattr(xbox360_controller, name)
+
+
+def compile_step(binding, presets):
+    """
+    Returns:
+        A (LightController method, keyword arguments, needs the bulb on) tuple.
+    """
+
+    if isinstance(binding, dict):
+        return "set_bulb_state", check_changes(dict(binding)), True
+    if binding in ACTIONS:
+        return binding, {}, ACTIONS[binding]
+    if binding in presets:
+        return "set_bulb_state", dict(presets[binding]), True
+    raise ValueError(f"Unknown action or preset {binding!r}")
+
+
+def compile_binding(binding, presets, macros):
+    if not isinstance(binding, dict) and binding in macros:
+        return tuple(compile_step(step, presets) for step in macros[binding])
+    return compile_step(binding, presets),
+
+
+def compile_mapping(mapping):
+    """
+    Checks the whole mapping and flattens it, so handling an event is a single
+    dictionary lookup.
+
+    Returns:
+        (dispatch table, combo modifier buttons). The table maps (event type,
+        held modifier button or None, button or pad direction index) to a tuple of
+        steps, see compile_step().
+    """
+
+    presets = {}
+    for name, state in mapping.get("presets", {}).items():
+        if not isinstance(state, dict) or name in ACTIONS:
+            raise ValueError(f"Preset {name!r} must be a state and can't be named like an action")
+        try:
+            presets[name] = check_changes(dict(state))
+        except ValueError as e:
+            raise ValueError(f"Preset {name!r}: {e}") from None
+    macros = mapping.get("macros", {})
+    for name, steps in macros.items():
+        if not isinstance(steps, list) or name in ACTIONS or name in presets:
+            raise ValueError(f"Macro {name!r} must be a list of steps and can't be named like an action or preset")
+
+    table = {}
+    for name, binding in mapping.get("buttons", {}).items():
+        table[(pygame.JOYBUTTONUP, None, parse_button(name))] = compile_binding(binding, presets, macros)
+    for name, binding in mapping.get("pad", {}).items():
+        if name not in PAD_DIRECTIONS:
+            raise ValueError(f"Unknown pad direction {name!r}, expected one of {', '.join(PAD_DIRECTIONS)}")
+        table[(pygame.JOYHATMOTION, None, PAD_DIRECTIONS.index(name))] = compile_binding(binding, presets, macros)
+    modifiers = set()
+    for combo, binding in mapping.get("combos", {}).items():
+        names = combo.split("+")
+        if len(names) != 2:
+            raise ValueError(f"Combo {combo!r} must be two buttons, e.g. LEFT_BUMP+A")
+        modifier = parse_button(names[0])
+        if names[1] in PAD_DIRECTIONS:
+            key = (pygame.JOYHATMOTION, modifier, PAD_DIRECTIONS.index(names[1]))
+        else:
+            key = (pygame.JOYBUTTONUP, modifier, parse_button(names[1]))
+        table[key] = compile_binding(binding, presets, macros)
+        modifiers.add(modifier)
+    return table, frozenset(modifiers)
+
+
+class ButtonMapping:
+    """
+    The compiled mapping, either the built-in one or loaded from a file that is
+    compiled again whenever it changes. A new mapping replaces the old one only
+    once it compiled completely, a broken file keeps the previous mapping.
+    """
+    # how often (at most) the file is checked, only while events come in
+    check_interval = 1
+
+    def __init__(self, path=None):
+        self.path = path
+        self.mtime = None
+        self.checked_at = 0
+        self.table, self.modifiers = compile_mapping(DEFAULT_MAPPING)
+        if path:
+            self.reload_if_changed()
+
+    def reload_if_changed(self):
+        """
+        Returns:
+            Whether a new mapping was loaded.
+        """
+
+        if not self.path or time() - self.checked_at < self.check_interval:
+            return False
+        self.checked_at = time()
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+            if mtime == self.mtime:
+                return False
+            self.mtime = mtime
+            with open(self.path) as f:
+                table, modifiers = compile_mapping(json.load(f))
+        except (OSError, ValueError, TypeError, AttributeError) as e:
+            print("Could not load button mapping:", e)
+            return False
+        self.table, self.modifiers = table, modifiers
+        print("Loaded button mapping from", self.path)
+        return True
+
+    def states(self):
+        """
+        Returns:
+            The distinct states the mapping sets, the ones worth precaching.
+        """
+
+        states = {}
+        for steps in self.table.values():
+            for method, arguments, _ in steps:
+                if method == "set_bulb_state":
+                    states[tuple(sorted(arguments.items()))] = arguments
+        return list(states.values())
+
+    def get(self, event_type, modifier, code):
+        """
+        Returns:
+            (steps, whether it was a combo), or (None, False) for an unmapped event.
+        """
+
+        if modifier is not None:
+            steps = self.table.get((event_type, modifier, code))
+            if steps is not None:
+                return steps, True
+        return self.table.get((event_type, None, code)), False
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write the built-in button mapping to a file")
+    parser.add_argument("path")
+    args = parser.parse_args()
+    with open(args.path, "w") as f:
+        json.dump(DEFAULT_MAPPING, f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
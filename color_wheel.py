@@ -0,0 +1,56 @@
+import colorsys
+import math
+from array import array
+
+
+class ColorWheel:
+    """
+    Maps a stick position to a color: the angle picks the hue (red to the right,
+    counterclockwise through green and blue) and the distance from the center the
+    saturation, at full value (brightness is left to the right stick).
+
+    Every color the bulb can show at that resolution is computed once into a flat
+    array of red, green, blue bytes, so a stick update is a single lookup.
+    """
+    # the bulb's 8 bit channels can't tell finer steps apart
+    hue_steps = 256
+    saturation_steps = 256
+
+    def __init__(self):
+        # built on first use, it takes a moment and most sessions never use the wheel
+        self.table = None
+
+    def build_table(self):
+        """
+        Returns:
+            An array of saturation_steps rows, each holding the red, green and blue
+            bytes of every hue.
+        """
+
+        saturated = bytes(round(channel * 255) for hue in range(self.hue_steps)
+                          for channel in colorsys.hsv_to_rgb(hue / self.hue_steps, 1, 1))
+        table = array("B")
+        for saturation in range(self.saturation_steps):
+            # a paler color moves each channel of the fully saturated one towards white,
+            # the same way for every hue, so a whole row is one translate()
+            whiteness = 1 - saturation / (self.saturation_steps - 1)
+            table.frombytes(saturated.translate(bytes(round(channel + (255 - channel) * whiteness)
+                                                      for channel in range(256))))
+        return table
+
+    def lookup(self, x, y, saturation):
+        """
+        Args:
+            x, y: The stick position, up is positive.
+            saturation: 0 (white) to 1.
+
+        Returns:
+            A (red, green, blue) tuple.
+        """
+
+        if self.table is None:
+            self.table = self.build_table()
+        hue = round(math.atan2(y, x) / math.tau * self.hue_steps) % self.hue_steps
+        saturation = round(min(max(saturation, 0), 1) * (self.saturation_steps - 1))
+        offset = (saturation * self.hue_steps + hue) * 3
+        return tuple(self.table[offset:offset + 3])
@@ -38,4 +38,46 @@ lamp_colors = [
     (255, 0, 0),      # Red (Bright Red)
     (178, 34, 34),    # Firebrick (Deep Red)
     (139, 0, 0)       # Dark Red (Rich Red)
-]
\ No newline at end of file
+]
+
+sunset_colors = [
+    (255, 94, 77),    # Sunset Orange
+    (255, 149, 5),    # Amber
+    (255, 200, 87),   # Golden Hour
+    (252, 92, 125),   # Dusk Pink
+    (106, 76, 147),   # Twilight Purple
+    (48, 25, 52),     # Night Plum
+]
+
+ocean_colors = [
+    (0, 105, 148),    # Sea Blue
+    (0, 150, 199),    # Ocean Blue
+    (72, 202, 228),   # Shallow Water
+    (144, 224, 239),  # Foam
+    (0, 180, 160),    # Lagoon
+    (2, 62, 138),     # Deep Sea
+]
+
+forest_colors = [
+    (34, 139, 34),    # Forest Green
+    (85, 107, 47),    # Moss
+    (154, 205, 50),   # Fresh Leaves
+    (218, 165, 32),   # Autumn Gold
+    (139, 69, 19),    # Bark
+]
+
+fire_colors = [
+    (255, 0, 0),      # Red
+    (255, 69, 0),     # Orange Red
+    (255, 140, 0),    # Dark Orange
+    (255, 200, 0),    # Flame Yellow
+    (178, 34, 34),    # Ember
+]
+
+palettes = {
+    "lamp": lamp_colors,
+    "sunset": sunset_colors,
+    "ocean": ocean_colors,
+    "forest": forest_colors,
+    "fire": fire_colors,
+}
@@ -0,0 +1,213 @@
+import asyncio
+from time import perf_counter
+
+from metrics import metrics
+
+# priority classes, lower is more urgent
+INPUT = 0
+RAMP = 1
+SCENE = 2
+PRIORITY_NAMES = ("input", "ramp", "scene")
+
+
+class CommandPipeline:
+    """
+    Sits between LightController and the bulb. Writes are queued by priority class
+    (direct input, then ramps, then scenes) and merged per field within a class
+    while waiting (newest value wins), so a burst of color changes becomes a single
+    packet. Only one packet is in flight at a time and the most urgent class goes
+    first, so a button press never waits behind scene frames. Background state
+    refreshes only run when nothing else is waiting.
+
+    Writes can carry a maximum age, once it has passed they are dropped instead of
+    sent (a late scene frame is not worth a packet). The gap between packets
+    follows the measured round trip time of the bulb, input doesn't wait for it.
+    While paused (bulb is unreachable) writes keep merging and are sent on resume.
+    """
+    min_send_interval = 0.02
+    max_send_interval = 1
+    rtt_smoothing = 0.2
+
+    def __init__(self, bulb, on_response=None, on_timeout=None):
+        self.bulb = bulb
+        self.bulb_available = asyncio.Event()
+        if bulb is not None:
+            self.bulb_available.set()
+        self.on_response = on_response
+        self.on_timeout = on_timeout
+        # priority -> merged changes, when the oldest of them was requested and when they go stale
+        self.pending = {}
+        self.pending_since = {}
+        self.deadlines = {}
+        self.is_refresh_requested = False
+        # cleared while a requested refresh hasn't been answered (or failed) yet
+        self.refreshed = asyncio.Event()
+        self.refreshed.set()
+        self.has_pending = asyncio.Event()
+        self.has_pending_input = asyncio.Event()
+        # the opposite of has_pending_input, for whoever paces its writes by the bulb (remote control clients)
+        self.input_sent = asyncio.Event()
+        self.input_sent.set()
+        self.smoothed_rtt = None
+        self.requested_writes = metrics.counter("bulb_writes_requested_total", "State changes requested by the program")
+        self.merged_writes = metrics.counter("bulb_writes_merged_total", "State changes merged into a pending packet")
+        self.dropped_writes = metrics.counter("bulb_writes_dropped_total", "Pending packets dropped because they got too old")
+        self.sent_packets = metrics.counter("bulb_packets_sent_total", "Packets sent by the command pipeline")
+        self.retries = metrics.counter("bulb_command_retries_total", "Packets requeued after the bulb failed to answer")
+        self.failed_writes = metrics.counter("bulb_writes_failed_total", "Packets dropped because sending them failed")
+        # time from the oldest merged request (e.g. a button press) until its packet was sent
+        self.command_latencies = [metrics.histogram("command_latency_seconds", "Time from a request until its packet was sent",
+                                                    priority=name)
+                                  for name in PRIORITY_NAMES]
+        self.command_latency = self.command_latencies[INPUT]
+
+    @property
+    def is_idle(self):
+        return not self.pending and not self.is_refresh_requested and not self.has_pending.is_set()
+
+    @property
+    def pending_changes(self):
+        # the more urgent classes win, they are sent first
+        changes = {}
+        for priority in sorted(self.pending, reverse=True):
+            changes.update(self.pending[priority])
+        return changes
+
+    @property
+    def send_interval(self):
+        if self.smoothed_rtt is None:
+            return self.min_send_interval
+        return min(max(self.smoothed_rtt, self.min_send_interval), self.max_send_interval)
+
+    def pause(self):
+        self.bulb_available.clear()
+
+    def resume(self, bulb):
+        self.bulb = bulb
+        self.bulb_available.set()
+
+    def set_state(self, priority=INPUT, requested_at=None, max_age=None, **changes):
+        now = perf_counter()
+        self.requested_writes.inc()
+        if priority in self.pending:
+            self.merged_writes.inc()
+        else:
+            self.pending[priority] = {}
+            self.pending_since[priority] = requested_at or now
+        self.pending[priority].update(changes)
+        self.deadlines[priority] = now + max_age if max_age is not None else None
+        # older writes of less urgent classes must not be sent after this one and undo it
+        for lower_priority in [p for p in self.pending if p > priority]:
+            lower_changes = self.pending[lower_priority]
+            for key in changes:
+                lower_changes.pop(key, None)
+            if not lower_changes:
+                self.discard(lower_priority)
+        self.has_pending.set()
+        if priority == INPUT:
+            self.has_pending_input.set()
+            self.input_sent.clear()
+
+    def request_refresh(self):
+        self.is_refresh_requested = True
+        self.refreshed.clear()
+        self.has_pending.set()
+
+    def discard(self, priority):
+        self.pending_since.pop(priority, None)
+        self.deadlines.pop(priority, None)
+        if priority == INPUT:
+            self.has_pending_input.clear()
+            self.input_sent.set()
+        return self.pending.pop(priority, None)
+
+    def update_rtt(self, rtt):
+        if self.smoothed_rtt is None:
+            self.smoothed_rtt = rtt
+        else:
+            self.smoothed_rtt += self.rtt_smoothing * (rtt - self.smoothed_rtt)
+
+    async def run(self):
+        from broadlink.exceptions import BroadlinkException
+
+        while True:
+            await self.has_pending.wait()
+            await self.bulb_available.wait()
+            if not self.pending:
+                await self.refresh()
+                continue
+            priority = min(self.pending)
+            requested_at = self.pending_since[priority]
+            deadline = self.deadlines[priority]
+            changes = self.discard(priority)
+            sent_at = perf_counter()
+            if deadline is not None and sent_at > deadline:
+                self.dropped_writes.inc()
+                # the shadow state already holds the dropped values, read back what the bulb really shows
+                self.is_refresh_requested = True
+                continue
+            self.command_latencies[priority].observe(sent_at - requested_at)
+            try:
+                bulb_state = await self.bulb.set_state(**changes)
+            except BroadlinkException:
+                # keep the values that were not overwritten meanwhile, they are sent once the bulb is back
+                self.pending[priority] = {**changes, **self.pending.get(priority, {})}
+                self.pending_since[priority] = requested_at
+                self.deadlines.setdefault(priority, deadline)
+                if priority == INPUT:
+                    self.has_pending_input.set()
+                    self.input_sent.clear()
+                self.retries.inc()
+                if self.on_timeout:
+                    self.on_timeout()
+                if self.bulb_available.is_set():
+                    await asyncio.sleep(self.max_send_interval)
+                continue
+            except Exception as e:
+                # anything else is a bug, the write is dropped but the pipeline keeps running
+                print(f"Could not send {changes}: {e!r}")
+                self.failed_writes.inc()
+                self.is_refresh_requested = True
+                continue
+            finally:
+                # the event stays set if new writes came in while this packet was in flight
+                if not self.pending and not self.is_refresh_requested:
+                    self.has_pending.clear()
+            rtt = perf_counter() - sent_at
+            self.sent_packets.inc()
+            self.update_rtt(rtt)
+            # a response to an older packet would roll back the values still waiting to be sent
+            if self.on_response and not self.pending:
+                self.on_response(bulb_state)
+            await self.wait_send_interval(self.send_interval - rtt)
+
+    async def refresh(self):
+        from broadlink.exceptions import BroadlinkException
+
+        self.is_refresh_requested = False
+        try:
+            bulb_state = await self.bulb.get_state()
+        except Exception as e:
+            print("Could not refresh bulb state", "" if isinstance(e, BroadlinkException) else repr(e))
+            self.refreshed.set()
+            return
+        finally:
+            if not self.pending and not self.is_refresh_requested:
+                self.has_pending.clear()
+        if self.on_response and not self.pending:
+            self.on_response(bulb_state)
+        self.refreshed.set()
+
+    async def wait_send_interval(self, delay):
+        # input cuts the pause short, only the background classes are paced
+        if delay <= 0 or self.has_pending_input.is_set():
+            return
+        try:
+            await asyncio.wait_for(self.has_pending_input.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+
+    def __str__(self):
+        rtt = f"{self.smoothed_rtt * 1000:.0f}ms" if self.smoothed_rtt is not None else "-"
+        return (f"writes: {self.requested_writes.value} - packets: {self.sent_packets.value} - "
+                f"dropped: {self.dropped_writes.value} - rtt: {rtt}")
@@ -0,0 +1,95 @@
+import asyncio
+import os
+import threading
+from time import perf_counter, sleep
+
+import pygame
+
+
+def init_joystick_events():
+    """
+    Starts only what joystick events need, instead of pygame.init() also bringing
+    up audio, fonts and the rest.
+    """
+    # pygame keeps the event queue in the video subsystem, the dummy driver provides it without a display
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    pygame.display.init()
+    pygame.joystick.init()
+
+
+class ControllerInput:
+    """
+    Waits for pygame events on a reader thread and hands them to the asyncio loop
+    as soon as they arrive, stamped with the time they were received. SDL reads
+    device events on the thread that initialized it, so the reader thread also
+    starts pygame, ready is done once it did.
+
+    SDL wakes up every millisecond while it waits for an event (about 860 wakeups/s
+    and 1.5% of a core measured). With idle_poll_interval set, once the pad has been
+    left alone for idle_after seconds the reader only looks at the queue that often
+    instead, e.g. 0.1 gives 10 wakeups/s and about 0.1% CPU, but the first press
+    after a pause then waits up to that long (54ms on average). That first press is
+    the one a light switch is used for, so by default the reader always waits.
+    """
+    # only bounds how long stop() takes to end the reader thread, events are delivered right away
+    wait_timeout_ms = 500
+    idle_after = 5
+    # seconds between looks at the queue while idle, None never polls
+    idle_poll_interval = None
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.ready = loop.create_future()
+        self.events = asyncio.Queue()
+        self.is_running = False
+        self.reader = None
+
+    def start(self):
+        self.is_running = True
+        self.reader = threading.Thread(target=self.run_reader, name="controller-input", daemon=True)
+        self.reader.start()
+
+    def stop(self):
+        self.is_running = False
+        # wake up whoever waits in get_batch()
+        self.events.put_nowait(None)
+
+    async def get_batch(self):
+        """
+        Waits for at least one event, then also takes everything else that is
+        already queued.
+
+        Returns:
+            A list of (event, received_at) tuples, empty once the input was stopped.
+        """
+        batch = []
+        received = await self.events.get()
+        while received is not None:
+            batch.append(received)
+            if self.events.empty():
+                return batch
+            received = self.events.get_nowait()
+        if batch:
+            # hand out what arrived before stop() first, the next call returns the empty list
+            self.events.put_nowait(None)
+        return batch
+
+    def run_reader(self):
+        try:
+            init_joystick_events()
+        except pygame.error as e:
+            self.loop.call_soon_threadsafe(self.ready.set_exception, e)
+            return
+        self.loop.call_soon_threadsafe(self.ready.set_result, None)
+        last_event_at = perf_counter()
+        while self.is_running:
+            if self.idle_poll_interval is None or perf_counter() - last_event_at < self.idle_after:
+                events = [pygame.event.wait(self.wait_timeout_ms)]
+            else:
+                sleep(self.idle_poll_interval)
+                events = pygame.event.get()
+            for event in events:
+                if event.type == pygame.NOEVENT:
+                    continue
+                last_event_at = perf_counter()
+                self.loop.call_soon_threadsafe(self.events.put_nowait, (event, last_event_at))
@@ -0,0 +1,37 @@
+from axis_filter import AxisFilter
+
+
+class ControllerSession:
+    """
+    Everything that belongs to one connected pad: the buttons it holds, its color
+    wheel mode, its brightness ramp and stick filter. Every pad gets its own
+    session, so two pads in one room don't step on each other's holds.
+    """
+
+    def __init__(self, instance_id, controller):
+        self.instance_id = instance_id
+        self.controller = controller
+        self.controller_state = None
+        self.has_axis_moved = False
+        self.currently_held_button = None
+        self.currently_held_button_press_timestamp = None
+        # the combo button (see ButtonMapping) held right now, and whether a combo used it already
+        self.held_modifier = None
+        self.is_modifier_used = False
+        self.is_wheel_color_mode = False
+        # how far the stick was pushed since it left the dead zone, the saturation of the wheel color
+        self.wheel_saturation = 0
+        self.brightness_loop = None
+        self.is_brightness_loop_running = False
+        # stick position (up is positive) read by the brightness loop, which turns it into steps per tick
+        self.right_stick_y = 0
+        self.brightness_axis = AxisFilter(max_step=10)
+
+    def close(self):
+        if self.brightness_loop:
+            self.brightness_loop.cancel()
+        self.is_wheel_color_mode = False
+        self.is_brightness_loop_running = False
+
+    def __str__(self):
+        return f"Controller {self.instance_id}"
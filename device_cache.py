@@ -0,0 +1,76 @@
+import json
+import os
+
+from bulb import bulb_address, parse_bulb_address
+
+CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".device_cache.json")
+
+
+class DeviceCache:
+    """
+    Remembers authenticated bulbs (address, MAC, device type and session) on disk,
+    so a restart can talk to them right away instead of discovering and
+    authenticating them again.
+    """
+
+    def __init__(self, path=CACHE_PATH):
+        self.path = path
+        self.entries = self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save(self):
+        # write to a temporary file first so a crash never leaves a half written cache behind
+        temp_path = self.path + ".tmp"
+        try:
+            with open(temp_path, "w") as f:
+                json.dump(self.entries, f, indent=2)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            print("Could not save device cache:", e)
+
+    def store(self, devices):
+        self.entries = {}
+        for device in devices:
+            self.entries[bulb_address(device)] = {
+                "mac": device.mac.hex(),
+                "devtype": device.devtype,
+                "name": device.name,
+                "id": device.id,
+                # broadlink only keeps the cipher, the session key is read back from it
+                "key": device.aes.algorithm.key.hex(),
+            }
+        self.save()
+
+    def restore(self, bulb_ips):
+        """
+        Returns:
+            The cached devices, already holding their session, for the given IPs
+            that are in the cache (or for every cached bulb when no IPs are given).
+        """
+
+        bulb_ips = [bulb_ip for bulb_ip in bulb_ips or self.entries if bulb_ip in self.entries]
+        if not bulb_ips:
+            return []
+        import broadlink
+
+        devices = []
+        for bulb_ip in bulb_ips:
+            entry = self.entries[bulb_ip]
+            device = broadlink.gendevice(entry["devtype"], parse_bulb_address(bulb_ip), entry["mac"], name=entry["name"])
+            device.id = entry["id"]
+            device.update_aes(bytes.fromhex(entry["key"]))
+            devices.append(device)
+        return devices
+
+    def clear(self):
+        self.entries = {}
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
@@ -0,0 +1,179 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import struct
+import threading
+from time import perf_counter
+
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+INIT_KEY = bytes.fromhex("097628343fe99e23765c1513accf8b02")
+INIT_VECT = bytes.fromhex("562e17996d093d28ddb3ba695a2e6f58")
+# one of the LB1 product IDs broadlink knows about
+BULB_DEVTYPE = 0x60C8
+
+DISCOVER = 0x06
+AUTH = 0x65
+COMMAND = 0x6A
+AUTHORIZATION_ERROR = -7
+
+
+class EmulatedBulb(asyncio.DatagramProtocol):
+    """
+    Speaks enough of the broadlink smart bulb protocol over UDP (hello, auth and
+    the LB1 get/set state commands) for bulb.initialize_connection and the rest
+    of the program to use it like a real bulb. Round trip time, jitter and packet
+    loss are configurable, and every state write is recorded for benchmarks.
+    """
+
+    def __init__(self, mac=None, name="Smart Bulb", rtt=0.0, jitter=0.0, loss=0.0):
+        self.mac = mac or os.urandom(6)
+        self.name = name
+        self.rtt = rtt
+        self.jitter = jitter
+        self.loss = loss
+        self.session_id = random.randint(1, 0xFFFFFFFF)
+        self.session_key = os.urandom(16)
+        self.state = {"pwr": 1, "red": 255, "green": 255, "blue": 255, "brightness": 50, "colortemp": 2700,
+                      "hue": 0, "saturation": 0, "transitionduration": 0, "maxworktime": 0, "bulb_colormode": 0,
+                      "bulb_scenes": "", "bulb_scene": "", "bulb_sceneidx": 255}
+        self.received_packets = 0
+        self.dropped_packets = 0
+        # (received_at, changes) of every set_state, timestamps use perf_counter
+        self.writes = []
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    @property
+    def address(self):
+        host, port = self.transport.get_extra_info("sockname")[:2]
+        return f"{host}:{port}"
+
+    def datagram_received(self, data, addr):
+        received_at = perf_counter()
+        self.received_packets += 1
+        if random.random() < self.loss:
+            self.dropped_packets += 1
+            return
+        response = self.handle_packet(data, received_at)
+        if response is None:
+            return
+        delay = max(self.rtt + random.uniform(-self.jitter, self.jitter), 0)
+        if delay:
+            asyncio.get_running_loop().call_later(delay, self.transport.sendto, response, addr)
+        else:
+            self.transport.sendto(response, addr)
+
+    def handle_packet(self, data, received_at):
+        if len(data) < 0x30:
+            return None
+        packet_type = int.from_bytes(data[0x26:0x28], "little")
+        if packet_type == DISCOVER and len(data) == 0x30:
+            return self.hello_response()
+        if len(data) < 0x38:
+            return None
+        count = data[0x28:0x2A]
+        if packet_type == AUTH:
+            return self.response(packet_type, count, self.session_id.to_bytes(4, "little") + self.session_key, INIT_KEY)
+        if packet_type != COMMAND:
+            return None
+        if int.from_bytes(data[0x30:0x34], "little") != self.session_id:
+            return self.response(packet_type, count, b"", self.session_key, error=AUTHORIZATION_ERROR)
+        payload = decrypt(self.session_key, data[0x38:])
+        flag = payload[0x08]
+        js_len = struct.unpack_from("<I", payload, 0x0A)[0]
+        if flag == 2:
+            changes = json.loads(payload[0x0E:0x0E + js_len])
+            self.state.update(changes)
+            self.writes.append((received_at, changes))
+        return self.response(packet_type, count, encode_state(self.state), self.session_key)
+
+    def hello_response(self):
+        packet = bytearray(0x80)
+        packet[0x34:0x36] = BULB_DEVTYPE.to_bytes(2, "little")
+        packet[0x3A:0x40] = self.mac[::-1]
+        name = self.name.encode()
+        packet[0x40:0x40 + len(name)] = name
+        return bytes(packet)
+
+    def response(self, packet_type, count, payload, key, error=0):
+        packet = bytearray(0x38)
+        packet[0x00:0x08] = bytes.fromhex("5aa5aa555aa5aa55")
+        packet[0x22:0x24] = error.to_bytes(2, "little", signed=True)
+        packet[0x24:0x26] = BULB_DEVTYPE.to_bytes(2, "little")
+        packet[0x26:0x28] = packet_type.to_bytes(2, "little")
+        packet[0x28:0x2A] = count
+        packet[0x2A:0x30] = self.mac[::-1]
+        packet[0x30:0x34] = self.session_id.to_bytes(4, "little")
+        if payload:
+            packet.extend(encrypt(key, payload + bytes((16 - len(payload)) % 16)))
+        checksum = sum(packet, 0xBEAF) & 0xFFFF
+        packet[0x20:0x22] = checksum.to_bytes(2, "little")
+        return bytes(packet)
+
+
+def encode_state(state):
+    data = json.dumps(state, separators=(",", ":")).encode()
+    packet = bytearray(14)
+    struct.pack_into("<HHHHBBI", packet, 0, 12 + len(data), 0xA5A5, 0x5A5A, 0, 1, 0x0B, len(data))
+    packet.extend(data)
+    checksum = sum(packet[0x02:], 0xBEAF) & 0xFFFF
+    packet[0x06:0x08] = checksum.to_bytes(2, "little")
+    return bytes(packet)
+
+
+def encrypt(key, payload):
+    encryptor = Cipher(algorithms.AES(key), modes.CBC(INIT_VECT)).encryptor()
+    return encryptor.update(payload) + encryptor.finalize()
+
+
+def decrypt(key, payload):
+    decryptor = Cipher(algorithms.AES(key), modes.CBC(INIT_VECT)).decryptor()
+    return decryptor.update(payload) + decryptor.finalize()
+
+
+async def start_bulbs(count=1, host="127.0.0.1", port=0, **bulb_options):
+    loop = asyncio.get_running_loop()
+    bulbs = []
+    for i in range(count):
+        _, bulb = await loop.create_datagram_endpoint(lambda: EmulatedBulb(**bulb_options),
+                                                      local_addr=(host, port + i if port else 0))
+        bulbs.append(bulb)
+    return bulbs
+
+
+def start_bulbs_in_thread(count=1, host="127.0.0.1", port=0, **bulb_options):
+    """
+    Runs emulated bulbs on their own event loop in a background thread, so they
+    answer independently of the loop of the program under test.
+
+    Returns:
+        The list of started EmulatedBulb instances.
+    """
+
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="bulb-emulator", daemon=True).start()
+    return asyncio.run_coroutine_threadsafe(start_bulbs(count, host, port, **bulb_options), loop).result()
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Emulate broadlink smart bulbs on the local machine")
+    parser.add_argument("--count", type=int, default=1, help="number of bulbs, on consecutive ports")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--rtt", type=float, default=0.0, help="response delay in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random +/- variation of the delay in seconds")
+    parser.add_argument("--loss", type=float, default=0.0, help="probability of dropping a packet (0-1)")
+    args = parser.parse_args()
+
+    bulbs = await start_bulbs(args.count, args.host, args.port, rtt=args.rtt, jitter=args.jitter, loss=args.loss)
+    print("Emulated bulbs listening, use: BULB_IP=" + ",".join(bulb.address for bulb in bulbs))
+    await asyncio.Event().wait()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,208 @@
+"""
+Records controller input to a compact binary log and replays it into
+LightController.handle_joystick_controls without a display or joystick.
+
+    python input_recorder.py session.rec             # replay in real time
+    python input_recorder.py session.rec --fast      # replay as fast as possible
+    python input_recorder.py session.rec --emulate   # replay against an emulated bulb
+
+Recording is enabled by setting RECORD_INPUT=<path> when running main.py.
+"""
+import argparse
+import asyncio
+import os
+import struct
+from time import perf_counter
+
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+
+import pygame
+
+import xbox360_controller
+
+MAGIC = b"XLCREC2\n"
+# nanoseconds since the recording started, event kind, instance id, button/axis/hat index, two values. SDL gives
+# every (re)connected pad a new instance id, so it gets 32 bits
+RECORD = struct.Struct("<QBIBhh")
+AXIS_SCALE = 32767
+
+EVENT_KINDS = {
+    pygame.JOYBUTTONDOWN: 1,
+    pygame.JOYBUTTONUP: 2,
+    pygame.JOYAXISMOTION: 3,
+    pygame.JOYHATMOTION: 4,
+}
+EVENT_TYPES = {kind: event_type for event_type, kind in EVENT_KINDS.items()}
+
+
+class InputRecorder:
+    def __init__(self, path):
+        self.file = open(path, "wb")
+        self.file.write(MAGIC)
+        self.started_at = None
+
+    def record(self, event, received_at):
+        kind = EVENT_KINDS.get(event.type)
+        if kind is None:
+            return
+        if self.started_at is None:
+            self.started_at = received_at
+        if event.type == pygame.JOYAXISMOTION:
+            index, values = event.axis, (round(event.value * AXIS_SCALE), 0)
+        elif event.type == pygame.JOYHATMOTION:
+            index, values = event.hat, event.value
+        else:
+            index, values = event.button, (0, 0)
+        timestamp = round((received_at - self.started_at) * 1e9)
+        self.file.write(RECORD.pack(timestamp, kind, getattr(event, "instance_id", 0), index, *values))
+
+    def close(self):
+        self.file.close()
+
+
+def read_recording(path):
+    """
+    Yields:
+        (seconds since the recording started, pygame event) for every recorded event.
+    """
+
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not an input recording")
+        while record := f.read(RECORD.size):
+            if len(record) < RECORD.size:
+                break
+            timestamp, kind, instance_id, index, value, second_value = RECORD.unpack(record)
+            event_type = EVENT_TYPES[kind]
+            if event_type == pygame.JOYAXISMOTION:
+                attributes = {"axis": index, "value": value / AXIS_SCALE}
+            elif event_type == pygame.JOYHATMOTION:
+                attributes = {"hat": index, "value": (value, second_value)}
+            else:
+                attributes = {"button": index}
+            yield timestamp / 1e9, pygame.event.Event(event_type, instance_id=instance_id, **attributes)
+
+
+class ReplayController:
+    """
+    Stands in for xbox360_controller.Controller during a replay, answering stick
+    and pad queries from the replayed events instead of a joystick.
+    """
+
+    def __init__(self, dead_zone=0.15):
+        self.dead_zone = dead_zone
+        self.axes = {}
+        self.hat = (0, 0)
+        self.pressed_buttons = set()
+
+    def update(self, event):
+        if event.type == pygame.JOYBUTTONDOWN:
+            self.pressed_buttons.add(event.button)
+        elif event.type == pygame.JOYBUTTONUP:
+            self.pressed_buttons.discard(event.button)
+        elif event.type == pygame.JOYAXISMOTION:
+            self.axes[event.axis] = event.value
+        elif event.type == pygame.JOYHATMOTION:
+            self.hat = event.value
+
+    def dead_zone_adjustment(self, value):
+        return xbox360_controller.Controller.dead_zone_adjustment(self, value)
+
+    def get_left_stick(self):
+        return (self.dead_zone_adjustment(self.axes.get(xbox360_controller.LEFT_STICK_X, 0)),
+                self.dead_zone_adjustment(self.axes.get(xbox360_controller.LEFT_STICK_Y, 0)))
+
+    def get_right_stick(self):
+        return (self.dead_zone_adjustment(self.axes.get(xbox360_controller.RIGHT_STICK_X, 0)),
+                self.dead_zone_adjustment(self.axes.get(xbox360_controller.RIGHT_STICK_Y, 0)))
+
+    def get_triggers(self):
+        if hasattr(xbox360_controller, "TRIGGERS"):
+            return -1 * self.axes.get(xbox360_controller.TRIGGERS, 0)
+        # an unused trigger rests at -1
+        return (-1 * self.axes.get(xbox360_controller.LEFT_TRIGGER, -1) +
+                self.axes.get(xbox360_controller.RIGHT_TRIGGER, -1)) / 2
+
+    def get_pad(self):
+        hat_x, hat_y = self.hat
+        return int(hat_y == 1), int(hat_x == 1), int(hat_y == -1), int(hat_x == -1)
+
+    def snapshot(self):
+        buttons = tuple(int(button in self.pressed_buttons) for button in xbox360_controller.SNAPSHOT_BUTTONS)
+        return xbox360_controller.ControllerState(buttons, self.get_left_stick(), self.get_right_stick(),
+                                                  self.get_triggers(), self.get_pad())
+
+
+async def replay(light_controller, path, realtime=True):
+    """
+    Feeds a recording into light_controller.handle_joystick_controls. In fast mode
+    events are handled back to back, so holds that depend on elapsed time (e.g.
+    the wheel color mode) don't trigger.
+
+    Returns:
+        The number of replayed events.
+    """
+
+    started_at = perf_counter()
+    events = 0
+    for timestamp, event in read_recording(path):
+        if realtime:
+            await asyncio.sleep(max(started_at + timestamp - perf_counter(), 0))
+        else:
+            # still let the pipeline and loops run between events
+            await asyncio.sleep(0)
+        # every pad of the recording gets its own session, like when they were connected
+        session = light_controller.sessions.get(event.instance_id)
+        if session is None:
+            session = light_controller.add_controller(event.instance_id, ReplayController())
+        session.controller.update(event)
+        received_at = perf_counter()
+        await light_controller.handle_joystick_controls(event, session, received_at)
+        if session.has_axis_moved:
+            light_controller.handle_controller_snapshot(session, received_at)
+        events += 1
+    return events
+
+
+async def main():
+    from dotenv import load_dotenv
+    from LightController import LightController
+
+    parser = argparse.ArgumentParser(description="Replay a recorded controller session")
+    parser.add_argument("recording")
+    parser.add_argument("--fast", action="store_true", help="replay as fast as possible instead of in real time")
+    parser.add_argument("--emulate", action="store_true", help="replay against an emulated bulb")
+    args = parser.parse_args()
+
+    load_dotenv()
+    if args.emulate:
+        import emulator
+        import tempfile
+        from device_cache import DeviceCache
+        bulb_ip = emulator.start_bulbs_in_thread(1)[0].address
+    else:
+        bulb_ip = os.getenv("BULB_IP")
+    light_controller = LightController(bulb_ip, os.getenv("SSID"), os.getenv("WIFI_PASS"))
+    if args.emulate:
+        # keep the emulated bulb out of the real device cache
+        light_controller.device_cache = DeviceCache(os.path.join(tempfile.mkdtemp(), "device_cache.json"))
+    if not await light_controller.start_bulb_tasks():
+        return
+
+    started_at = perf_counter()
+    events = await replay(light_controller, args.recording, realtime=not args.fast)
+    elapsed = perf_counter() - started_at
+    while not light_controller.command_pipeline.is_idle:
+        await asyncio.sleep(0.01)
+    pipeline = light_controller.command_pipeline
+    print("===============")
+    print(f"Replayed {events} events in {elapsed:.2f}s")
+    print(f"Writes: {pipeline.requested_writes.value} - packets: {pipeline.sent_packets.value} - "
+          f"merged: {pipeline.merged_writes.value} - retries: {pipeline.retries.value}")
+    print("Press to command latency:", pipeline.command_latency)
+    print(light_controller.bulb)
+    light_controller.stop()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -2,6 +2,11 @@ import os
 import asyncio
 from dotenv import load_dotenv
 from LightController import LightController
+from button_mapping import ButtonMapping
+from controller_input import ControllerInput
+from input_recorder import InputRecorder
+from remote_control import RemoteControlServer
+from metrics import serve_prometheus, dump_json_periodically, monitor_event_loop_lag
 
 
 async def main():
@@ -9,8 +14,31 @@ async def main():
     bulb_ip = os.getenv("BULB_IP")
     ssid = os.getenv("SSID")
     wifi_pass = os.getenv("WIFI_PASS")
+    metrics_port = os.getenv("METRICS_PORT")
+    metrics_json_path = os.getenv("METRICS_JSON_PATH")
+    record_input_path = os.getenv("RECORD_INPUT")
+    button_mapping_path = os.getenv("BUTTON_MAPPING")
+    remote_control_port = os.getenv("REMOTE_CONTROL_PORT")
+    audio_source = os.getenv("AUDIO_SOURCE")
+    idle_poll_interval = os.getenv("IDLE_POLL_INTERVAL")
 
+    if metrics_port:
+        await serve_prometheus(int(metrics_port))
+    if metrics_json_path:
+        asyncio.create_task(dump_json_periodically(metrics_json_path))
+    if metrics_port or metrics_json_path:
+        asyncio.create_task(monitor_event_loop_lag())
+
+    if idle_poll_interval:
+        ControllerInput.idle_poll_interval = float(idle_poll_interval)
     light_controller = LightController(bulb_ip, ssid, wifi_pass)
+    if record_input_path:
+        light_controller.input_recorder = InputRecorder(record_input_path)
+    light_controller.audio_source = audio_source
+    if button_mapping_path:
+        light_controller.button_mapping = ButtonMapping(button_mapping_path)
+    if remote_control_port:
+        await RemoteControlServer(light_controller, port=int(remote_control_port)).start()
     await light_controller.start()
 
 
@@ -0,0 +1,175 @@
+import asyncio
+import json
+import os
+from bisect import bisect_left
+from time import time, perf_counter
+
+# 0.5ms .. ~16s in steps of 2x, enough resolution for network round trips and loop lag
+LATENCY_BUCKETS = tuple(0.0005 * 2 ** i for i in range(16))
+
+
+class Counter:
+    def __init__(self, name, help_text, labels=None):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels or {}
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        yield self.name, self.labels, self.value
+
+    def as_dict(self):
+        return self.value
+
+
+class Histogram:
+    """
+    Fixed memory histogram: a count per bucket upper bound, plus sum and count.
+    Percentiles are estimated from the buckets.
+    """
+
+    def __init__(self, name, help_text, labels=None, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels or {}
+        self.buckets = buckets
+        # the last slot counts values above the highest bucket (+Inf)
+        self.bucket_counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.bucket_counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def percentile(self, percent):
+        if not self.count:
+            return None
+        rank = self.count * percent / 100
+        seen = 0
+        for i, bucket_count in enumerate(self.bucket_counts):
+            seen += bucket_count
+            if seen >= rank:
+                return self.buckets[i] if i < len(self.buckets) else float("inf")
+        return float("inf")
+
+    def samples(self):
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), self.bucket_counts):
+            cumulative += bucket_count
+            yield f"{self.name}_bucket", {**self.labels, "le": "+Inf" if bound == float("inf") else f"{bound:g}"}, cumulative
+        yield f"{self.name}_sum", self.labels, self.sum
+        yield f"{self.name}_count", self.labels, self.count
+
+    def as_dict(self):
+        return {"count": self.count, "sum": self.sum, "p50": self.percentile(50), "p95": self.percentile(95),
+                "p99": self.percentile(99)}
+
+    def __str__(self):
+        if not self.count:
+            return "-"
+        # the percentiles are bucket upper bounds, hence the "<"
+        return " / ".join(f"p{p}: <{self.percentile(p) * 1000:.1f}ms" for p in (50, 95, 99))
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = {}
+
+    def counter(self, name, help_text, **labels):
+        return self.get_or_create(Counter, name, help_text, labels)
+
+    def histogram(self, name, help_text, **labels):
+        return self.get_or_create(Histogram, name, help_text, labels)
+
+    def get_or_create(self, metric_class, name, help_text, labels):
+        key = (name, tuple(sorted(labels.items())))
+        if key not in self.metrics:
+            self.metrics[key] = metric_class(name, help_text, labels)
+        return self.metrics[key]
+
+    def prometheus_text(self):
+        # the exposition format wants all the samples of a metric name next to each other
+        families = {}
+        for metric in self.metrics.values():
+            families.setdefault(metric.name, []).append(metric)
+        lines = []
+        for name, family in families.items():
+            metric_type = "histogram" if isinstance(family[0], Histogram) else "counter"
+            lines.append(f"# HELP {name} {family[0].help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for metric in family:
+                for sample_name, labels, value in metric.samples():
+                    label_text = ",".join(f'{k}="{v}"' for k, v in labels.items())
+                    lines.append(f"{sample_name}{{{label_text}}} {value}" if label_text else f"{sample_name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def as_dict(self):
+        result = {}
+        for metric in self.metrics.values():
+            label_text = ",".join(f"{k}={v}" for k, v in metric.labels.items())
+            result[f"{metric.name}{{{label_text}}}" if label_text else metric.name] = metric.as_dict()
+        return result
+
+
+metrics = MetricsRegistry()
+
+
+async def serve_prometheus(port, host="127.0.0.1", registry=metrics):
+    async def handle_request(reader, writer):
+        try:
+            request_line = await reader.readline()
+            # the headers are not needed, but read them so the client is not cut off mid request
+            while (await reader.readline()).strip():
+                pass
+            if request_line.split(b" ")[1:2] == [b"/metrics"]:
+                body = registry.prometheus_text().encode()
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n")
+            else:
+                body = b"Not found\n"
+                writer.write(b"HTTP/1.1 404 Not Found\r\nContent-Type: text/plain\r\n")
+            writer.write(f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except (ConnectionError, IndexError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle_request, host, port)
+    print(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
+
+
+async def dump_json_periodically(path, interval=60, registry=metrics):
+    last_counters = {}
+    last_dump_at = perf_counter()
+    while True:
+        await asyncio.sleep(interval)
+        now = perf_counter()
+        snapshot = registry.as_dict()
+        # counters also get a per second rate over the last interval, e.g. controller events per second
+        rates = {}
+        for name, value in snapshot.items():
+            if isinstance(value, (int, float)):
+                rates[name] = (value - last_counters.get(name, 0)) / (now - last_dump_at)
+                last_counters[name] = value
+        last_dump_at = now
+        temp_path = path + ".tmp"
+        try:
+            with open(temp_path, "w") as f:
+                json.dump({"timestamp": time(), "metrics": snapshot, "rates_per_second": rates}, f, indent=2)
+            os.replace(temp_path, path)
+        except OSError as e:
+            print("Could not dump metrics:", e)
+
+
+async def monitor_event_loop_lag(interval=1, registry=metrics):
+    lag = registry.histogram("event_loop_lag_seconds", "How late the event loop woke up a sleeping task")
+    while True:
+        sleep_started_at = perf_counter()
+        await asyncio.sleep(interval)
+        lag.observe(max(perf_counter() - sleep_started_at - interval, 0))
@@ -0,0 +1,127 @@
+import struct
+from collections import OrderedDict
+
+from metrics import metrics
+
+COMMAND = 0x6A
+# the flag of the JSON payload
+READ = 1
+WRITE = 2
+# the order broadlink's lb1.set_state adds the keys in, so cached payloads are byte for byte what it would send
+STATE_KEYS = ("pwr", "red", "blue", "green", "brightness", "colortemp", "hue", "saturation", "transitionduration",
+              "maxworktime", "bulb_colormode", "bulb_scenes", "bulb_scene", "bulb_sceneidx")
+HEADER = struct.Struct("<HHH6sIH")
+
+
+def encode_value(key, value):
+    if key == "pwr":
+        return int(bool(value))
+    if key in ("bulb_scenes", "bulb_scene"):
+        return str(value)
+    return int(value)
+
+
+class PacketCache:
+    """
+    Builds the command packets of one device, keeping the encrypted payloads of
+    the states that repeat. The precached states (the colors of the button
+    mapping, palette entries) and the state read are pinned and never evicted. Any other state (scene,
+    wheel and audio frames) goes into a small table of the most recently used
+    ones, so a stream of one-off frames can't push out the presets. A cached
+    state only needs its packet header built before it goes out.
+
+    The payloads are encrypted with the session key, so they are dropped as soon
+    as the device authenticates again, and the pinned ones encrypted again on
+    their next use.
+    """
+    max_size = 32
+
+    def __init__(self, device, host):
+        self.device = device
+        self.pinned_states = {(READ,)}
+        self.pinned = {}
+        self.payloads = OrderedDict()
+        self.session_key = None
+        self.hits = metrics.counter("packet_cache_hits_total", "Command payloads sent from the cache", bulb=host)
+        self.misses = metrics.counter("packet_cache_misses_total", "Command payloads that had to be encrypted", bulb=host)
+
+    @staticmethod
+    def cache_key(changes, flag):
+        return flag, *((key, changes[key]) for key in STATE_KEYS if key in changes)
+
+    def get_payload(self, changes, flag=WRITE):
+        """
+        Returns:
+            (payload checksum, encrypted payload) of the command, a set_state by
+            default or a get_state with flag=READ and no changes.
+        """
+
+        session_key = self.device.aes.algorithm.key
+        if session_key != self.session_key:
+            self.pinned.clear()
+            self.payloads.clear()
+            self.session_key = session_key
+        state = self.cache_key(changes, flag)
+        payload = self.pinned.get(state)
+        if payload is None:
+            payload = self.payloads.get(state)
+            if payload is not None:
+                if state in self.pinned_states:
+                    # it was sent before it got pinned
+                    self.pinned[state] = self.payloads.pop(state)
+                else:
+                    self.payloads.move_to_end(state)
+        if payload is not None:
+            self.hits.inc()
+            return payload
+        self.misses.inc()
+        packet = self.device._encode(flag, {key: encode_value(key, value) for key, value in state[1:]})
+        checksum = sum(packet, 0xBEAF) & 0xFFFF
+        payload = (checksum, self.device.encrypt(packet + bytes((16 - len(packet)) % 16)))
+        if state in self.pinned_states:
+            self.pinned[state] = payload
+        else:
+            self.payloads[state] = payload
+            if len(self.payloads) > self.max_size:
+                self.payloads.popitem(last=False)
+        return payload
+
+    def precache(self, states):
+        # replaces the states pinned before, e.g. those of a button mapping that was changed since
+        self.pinned_states = {(READ,), *(self.cache_key(changes, WRITE) for changes in states)}
+        for state in [state for state in self.pinned if state not in self.pinned_states]:
+            del self.pinned[state]
+        for changes in states:
+            self.get_payload(changes)
+
+    def build_packet(self, packet_type, payload):
+        """
+        The same packet broadlink's send_packet builds, minus the encryption.
+
+        Returns:
+            (packet counter, packet).
+        """
+
+        payload_checksum, encrypted_payload = payload
+        device = self.device
+        device.count = ((device.count + 1) | 0x8000) & 0xFFFF
+        packet = bytearray(b"\x5a\xa5\xaa\x55\x5a\xa5\xaa\x55" + bytes(0x30))
+        HEADER.pack_into(packet, 0x24, device.devtype, packet_type, device.count, device.mac[::-1], device.id,
+                         payload_checksum)
+        packet += encrypted_payload
+        packet[0x20:0x22] = (sum(packet, 0xBEAF) & 0xFFFF).to_bytes(2, "little")
+        return device.count, packet
+
+
+def check_response(response):
+    from broadlink import exceptions
+
+    if len(response) < 0x30:
+        raise exceptions.DataValidationError(-4007, "Received data packet length error",
+                                             f"Expected at least 48 bytes and received {len(response)}")
+    nominal_checksum = int.from_bytes(response[0x20:0x22], "little")
+    checksum = sum(response, 0xBEAF) - sum(response[0x20:0x22]) & 0xFFFF
+    if checksum != nominal_checksum:
+        raise exceptions.DataValidationError(-4008, "Received data packet check error",
+                                             f"Expected a checksum of {nominal_checksum} and received {checksum}")
+    exceptions.check_error(response[0x22:0x24])
@@ -0,0 +1,117 @@
+"""
+Measures the remote control endpoint: many local WebSocket clients stream color
+changes as fast as they can to a LightController driving emulated bulbs. Reports
+the updates per second the server takes, how many of them reach the command
+pipeline after merging, the packets per second the bulbs get and the time from
+receiving an update until its packet was sent.
+
+    python remote_benchmark.py --clients 50 --duration 5
+
+The clients run in a separate process so they don't take CPU time from the server.
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+from time import perf_counter
+
+import emulator
+from device_cache import DeviceCache
+from LightController import LightController
+from remote_control import RemoteControlServer
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def client_frame(payload):
+    mask = os.urandom(4)
+    masked = bytes(byte ^ mask[i % 4] for i, byte in enumerate(payload))
+    return bytes((0x81, 0x80 | len(payload))) + mask + masked
+
+
+async def run_client(port, duration, rate, frames):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    key = base64.b64encode(os.urandom(16)).decode()
+    writer.write(f"GET /ws HTTP/1.1\r\nHost: 127.0.0.1\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                 f"Sec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n\r\n".encode())
+    await reader.readuntil(b"\r\n\r\n")
+    sent = 0
+    started_at = perf_counter()
+    while perf_counter() - started_at < duration:
+        if rate:
+            writer.write(random.choice(frames))
+            sent += 1
+            await asyncio.sleep(1 / rate)
+            continue
+        # a few messages per write, then wait for the socket, the server's reading sets the pace
+        for _ in range(10):
+            writer.write(random.choice(frames))
+        sent += 10
+        await writer.drain()
+    writer.write(bytes((0x88, 0x80)) + os.urandom(4))
+    await writer.drain()
+    writer.close()
+    return sent
+
+
+async def run_clients(port, clients, duration, rate):
+    # prebuilt messages, building them would be most of what the clients spend their time on
+    frames = [client_frame(json.dumps(dict(red=random.randrange(256), green=random.randrange(256),
+                                           blue=random.randrange(256))).encode()) for _ in range(256)]
+    sent = await asyncio.gather(*(run_client(port, duration, rate, frames) for _ in range(clients)))
+    print(sum(sent), flush=True)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Benchmark the remote control endpoint with many local clients")
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=5)
+    parser.add_argument("--bulbs", type=int, default=1)
+    parser.add_argument("--rtt", type=float, default=0.03)
+    parser.add_argument("--rate", type=float, default=0, help="updates per second per client, 0 sends as fast as possible")
+    parser.add_argument("--child", nargs=4, metavar=("PORT", "CLIENTS", "DURATION", "RATE"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        port, clients, duration, rate = args.child
+        await run_clients(int(port), int(clients), float(duration), float(rate))
+        return
+
+    bulbs = emulator.start_bulbs_in_thread(args.bulbs, rtt=args.rtt)
+    light_controller = LightController(",".join(bulb.address for bulb in bulbs), None, None)
+    light_controller.device_cache = DeviceCache(os.path.join(tempfile.mkdtemp(), "device_cache.json"))
+    if not await light_controller.start_bulb_tasks():
+        print("Could not connect to the emulated bulbs")
+        return
+    light_controller.bulb_state.update(pwr=1)
+    server = await RemoteControlServer(light_controller, port=0).start()
+
+    packets = sum(bulb.received_packets for bulb in bulbs)
+    started_at = perf_counter()
+    child = await asyncio.create_subprocess_exec(sys.executable, __file__, "--child", str(server.port),
+                                                 str(args.clients), str(args.duration), str(args.rate), cwd=HERE,
+                                                 stdout=subprocess.PIPE)
+    output, _ = await child.communicate()
+    duration = perf_counter() - started_at
+    received, applied = server.received_updates.value, server.applied_updates.value
+    packets = sum(bulb.received_packets for bulb in bulbs) - packets
+    # the server may still be reading what the clients sent last
+    while server.clients:
+        await asyncio.sleep(0.01)
+    server.close()
+
+    print("===============")
+    rate = f"{args.rate:.0f} updates/s each" if args.rate else "as fast as possible"
+    print(f"Clients: {args.clients} ({rate}) - bulbs: {args.bulbs} - rtt: {args.rtt * 1000:.0f}ms")
+    print(f"Sent: {int(output.split()[-1]) / duration:.0f} updates/s - read by the server: {received / duration:.0f} updates/s"
+          f" - rejected: {server.rejected_updates.value}")
+    print(f"Handed to the command pipeline: {applied / duration:.1f} writes/s - bulb packets: {packets / duration:.1f}/s")
+    print(f"Update to packet latency: {light_controller.command_pipeline.command_latency}")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
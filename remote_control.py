@@ -0,0 +1,276 @@
+"""
+Lets dashboards and automation set the bulb state next to the controllers, over
+a local HTTP and WebSocket endpoint:
+
+    GET  /state    the current (shadow) state as JSON
+    POST /state    a JSON object of changes, e.g. {"red": 255, "green": 0, "blue": 0}
+    GET  /ws       a WebSocket, every text (or binary) message is a JSON object of changes
+
+Changes go through LightController.set_bulb_state() like button presses, so the
+pad and remote clients share the shadow state and the command pipeline and the
+newest write wins.
+
+Browsers send an Origin header, requests from pages that aren't served from
+localhost are refused so a website can't drive the bulb through the visitor's
+browser. POST bodies must be sent as application/json, which a page can't do
+across origins without asking first.
+"""
+import asyncio
+import base64
+import hashlib
+import json
+import struct
+from time import perf_counter
+from urllib.parse import urlsplit
+
+from bulb_state import check_changes
+from metrics import metrics
+
+WEBSOCKET_GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+CLOSE = 0x8
+PING = 0x9
+PONG = 0xA
+LOCAL_HOSTNAMES = ("127.0.0.1", "localhost", "::1")
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def is_local_origin(origin):
+    try:
+        return urlsplit(origin).hostname in LOCAL_HOSTNAMES
+    except ValueError:
+        return False
+
+
+def parse_changes(data):
+    """
+    Returns:
+        The changes of a JSON message, raises ValueError if it isn't a valid one.
+    """
+
+    return check_changes(json.loads(data))
+
+
+def parse_frame(buffer, max_size):
+    """
+    Returns:
+        (first header byte, which holds the FIN flag and the opcode, unmasked payload)
+        of the first client frame in the buffer, which is then removed from it. None
+        if the frame didn't arrive completely yet.
+    """
+
+    if len(buffer) < 2:
+        return None
+    first, second = buffer[0], buffer[1]
+    if not second & 0x80:
+        raise ProtocolError("Client frames must be masked")
+    length = second & 0x7F
+    offset = 2
+    if length >= 126:
+        offset = 4 if length == 126 else 10
+        if len(buffer) < offset:
+            return None
+        length, = struct.unpack_from("!H" if length == 126 else "!Q", buffer, 2)
+    if length > max_size:
+        raise ProtocolError("Message too big")
+    end = offset + 4 + length
+    if len(buffer) < end:
+        return None
+    mask = bytes(buffer[offset:offset + 4]) * (length // 4 + 1)
+    # unmask the whole payload at once as a big integer, instead of byte by byte
+    payload = (int.from_bytes(buffer[offset + 4:end], "big") ^ int.from_bytes(mask[:length], "big")).to_bytes(length, "big")
+    del buffer[:end]
+    return first, payload
+
+
+def build_frame(opcode, payload=b""):
+    # messages from the server are never fragmented nor masked, and only carry control payloads (<126 bytes)
+    return bytes((0x80 | opcode, len(payload))) + payload
+
+
+class RemoteClient:
+    """
+    One WebSocket connection. Its messages are merged into one pending write
+    (newest value per field wins), which is handed to LightController only once
+    the previous write was sent to the bulb.
+
+    Nothing is read from the connection while a merged write waits for its turn,
+    so a client sending faster than the bulb takes writes is slowed down by TCP
+    instead of taking the CPU from the pad, the pipeline and the other clients.
+    """
+
+    def __init__(self, server, address):
+        self.server = server
+        self.address = address
+        self.pending = {}
+        self.pending_since = None
+        self.has_pending = asyncio.Event()
+        self.is_pending_taken = asyncio.Event()
+        self.is_pending_taken.set()
+
+    def merge(self, changes, received_at):
+        if self.pending:
+            self.server.merged_updates.inc()
+        else:
+            self.pending_since = received_at
+        self.pending.update(changes)
+        self.has_pending.set()
+        self.is_pending_taken.clear()
+
+    async def apply_pending(self):
+        light_controller = self.server.light_controller
+        pipeline = light_controller.command_pipeline
+        while True:
+            await self.has_pending.wait()
+            await pipeline.input_sent.wait()
+            changes, self.pending = self.pending, {}
+            self.has_pending.clear()
+            self.is_pending_taken.set()
+            light_controller.set_bulb_state(requested_at=self.pending_since, **changes)
+            self.server.applied_updates.inc()
+
+    def __str__(self):
+        return f"Remote client {self.address[0]}:{self.address[1]}"
+
+
+class RemoteControlServer:
+    """
+    A small HTTP server with WebSocket support on asyncio streams, enough for
+    local dashboards and automation without another dependency.
+    """
+    max_message_size = 64 * 1024
+    # read per turn of a client, everything in it is merged into one write
+    read_size = 4096
+
+    def __init__(self, light_controller, host="127.0.0.1", port=8765):
+        self.light_controller = light_controller
+        self.host = host
+        self.port = port
+        self.server = None
+        self.clients = set()
+        self.received_updates = metrics.counter("remote_updates_received_total", "State changes received from remote clients")
+        self.merged_updates = metrics.counter("remote_updates_merged_total",
+                                              "Remote state changes merged into a write still waiting for the bulb")
+        self.applied_updates = metrics.counter("remote_updates_applied_total", "Remote writes handed to the command pipeline")
+        self.rejected_updates = metrics.counter("remote_updates_rejected_total", "Invalid remote state changes")
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle_connection, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        print(f"Remote control on http://{self.host}:{self.port}/state and ws://{self.host}:{self.port}/ws")
+        return self
+
+    def close(self):
+        if self.server:
+            self.server.close()
+
+    async def handle_connection(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            headers = {}
+            while (line := (await reader.readline()).strip()):
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            method, path = request_line.decode("latin-1").split(" ")[:2]
+            if "origin" in headers and not is_local_origin(headers["origin"]):
+                self.respond(writer, "403 Forbidden", b"Only local pages may use this endpoint\n")
+            elif path == "/ws" and headers.get("upgrade", "").lower() == "websocket":
+                await self.handle_websocket(reader, writer, headers)
+            elif path == "/state":
+                await self.handle_state_request(reader, writer, method, headers)
+            else:
+                self.respond(writer, "404 Not Found", b"Not found\n")
+            await writer.drain()
+        except (ConnectionError, ValueError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def respond(self, writer, status, body=b"", content_type="text/plain"):
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n"
+                     f"Connection: close\r\n\r\n".encode() + body)
+
+    async def handle_state_request(self, reader, writer, method, headers):
+        if method == "GET":
+            self.respond(writer, "200 OK", json.dumps(self.light_controller.bulb_state.state).encode(), "application/json")
+            return
+        if method != "POST":
+            self.respond(writer, "405 Method Not Allowed", b"Use GET or POST\n")
+            return
+        if headers.get("content-type", "").partition(";")[0].strip().lower() != "application/json":
+            self.respond(writer, "415 Unsupported Media Type", b"Send the changes as application/json\n")
+            return
+        length = int(headers.get("content-length", 0))
+        if length > self.max_message_size:
+            self.respond(writer, "413 Payload Too Large", b"Too big\n")
+            return
+        body = await reader.readexactly(length)
+        received_at = perf_counter()
+        self.received_updates.inc()
+        try:
+            changes = parse_changes(body)
+        except ValueError as e:
+            self.rejected_updates.inc()
+            self.respond(writer, "400 Bad Request", f"{e}\n".encode())
+            return
+        self.light_controller.set_bulb_state(requested_at=received_at, **changes)
+        self.applied_updates.inc()
+        self.respond(writer, "204 No Content")
+
+    async def handle_websocket(self, reader, writer, headers):
+        key = headers.get("sec-websocket-key", "").encode()
+        accept = base64.b64encode(hashlib.sha1(key + WEBSOCKET_GUID).digest()).decode()
+        writer.write(f"HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                     f"Sec-WebSocket-Accept: {accept}\r\n\r\n".encode())
+        client = RemoteClient(self, writer.get_extra_info("peername") or ("?", 0))
+        self.clients.add(client)
+        applying = asyncio.create_task(client.apply_pending())
+        print(client, "connected")
+        try:
+            await self.read_messages(client, reader, writer)
+        except ProtocolError as e:
+            print(client, "-", e)
+            # 1002: protocol error
+            writer.write(build_frame(CLOSE, struct.pack("!H", 1002)))
+        finally:
+            applying.cancel()
+            self.clients.discard(client)
+            print(client, "disconnected")
+
+    async def read_messages(self, client, reader, writer):
+        buffer = bytearray()
+        message = b""
+        while True:
+            await client.is_pending_taken.wait()
+            data = await reader.read(self.read_size)
+            if not data:
+                return
+            buffer += data
+            received_at = perf_counter()
+            while (frame := parse_frame(buffer, self.max_message_size)) is not None:
+                header, payload = frame
+                opcode = header & 0x0F
+                if opcode == CLOSE:
+                    writer.write(build_frame(CLOSE, payload[:2]))
+                    return
+                if opcode == PING:
+                    writer.write(build_frame(PONG, payload[:125]))
+                    continue
+                if opcode == PONG:
+                    continue
+                # text, binary or a continuation of a fragmented message
+                message += payload
+                if len(message) > self.max_message_size:
+                    raise ProtocolError("Message too big")
+                if not header & 0x80:
+                    continue
+                self.received_updates.inc()
+                try:
+                    changes = parse_changes(message)
+                except ValueError:
+                    self.rejected_updates.inc()
+                else:
+                    client.merge(changes, received_at)
+                message = b""
@@ -0,0 +1,74 @@
+import asyncio
+from array import array
+from time import perf_counter
+
+from metrics import metrics
+
+
+def precompute_frames(palette, frame_rate, transition_time, hold_time=0, gamma=2.2):
+    """
+    Interpolates between consecutive palette colors (wrapping around to the first
+    one) in linear light, so fades don't dip in brightness halfway through.
+
+    Returns:
+        The frames as a flat array of r, g, b bytes.
+    """
+
+    to_linear = [(value / 255) ** gamma for value in range(256)]
+    transition_frames = max(round(transition_time * frame_rate), 1)
+    hold_frames = round(hold_time * frame_rate)
+    frames = array('B')
+    for color, next_color in zip(palette, palette[1:] + palette[:1]):
+        frames.extend(color * hold_frames)
+        for step in range(transition_frames):
+            progress = step / transition_frames
+            for start, end in zip(color, next_color):
+                linear = to_linear[start] + (to_linear[end] - to_linear[start]) * progress
+                frames.append(round(linear ** (1 / gamma) * 255))
+    return frames
+
+
+class Scene:
+    """
+    Plays precomputed frames on a fixed deadline schedule. When a frame is late
+    (slow bulb, busy loop) the frames that are already due are dropped instead of
+    shifting the rest of the scene.
+    """
+
+    def __init__(self, name, palette, frame_rate=10, transition_time=2.5, hold_time=0, gamma=2.2):
+        self.name = name
+        self.frame_rate = frame_rate
+        self.frames = precompute_frames(list(palette), frame_rate, transition_time, hold_time, gamma)
+        self.played_frames = metrics.counter("scene_frames_played_total", "Scene frames sent to the bulb", scene=name)
+        self.dropped_frames = metrics.counter("scene_frames_dropped_total", "Scene frames skipped to stay on schedule",
+                                              scene=name)
+        self.frame_lateness = metrics.histogram("scene_frame_lateness_seconds", "How late scene frames were sent",
+                                                scene=name)
+
+    def __len__(self):
+        return len(self.frames) // 3
+
+    def frame(self, index):
+        i = index % len(self) * 3
+        return self.frames[i], self.frames[i + 1], self.frames[i + 2]
+
+    async def play(self, send_frame, is_running):
+        interval = 1 / self.frame_rate
+        started_at = perf_counter()
+        frame_number = 0
+        last_frame = None
+        while is_running():
+            now = perf_counter()
+            due_frame = int((now - started_at) * self.frame_rate)
+            if due_frame > frame_number:
+                self.dropped_frames.inc(due_frame - frame_number)
+                frame_number = due_frame
+            self.frame_lateness.observe(now - started_at - frame_number * interval)
+            frame = self.frame(frame_number)
+            # held colors repeat the same frame, there is nothing to send for those
+            if frame != last_frame:
+                send_frame(*frame)
+                self.played_frames.inc()
+                last_frame = frame
+            frame_number += 1
+            await asyncio.sleep(max(started_at + frame_number * interval - perf_counter(), 0))
@@ -0,0 +1,100 @@
+"""
+Measures how long the program takes from process start until it handles controller
+input, against an emulated bulb, and which imports the startup spends its time on.
+
+    python startup_benchmark.py --runs 10
+
+The first run connects with an empty device cache (hello + auth), the others restart
+with the cache in place like a service restart on deploy.
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from time import perf_counter
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def profile_imports(top):
+    """
+    Returns:
+        The import time of main.py and its slowest imports (at any depth, so nested
+        ones are also counted in their parents) as (cumulative seconds, module)
+        tuples, based on python -X importtime.
+    """
+
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"], cwd=HERE,
+                            capture_output=True, text=True)
+    imports = {}
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:") and line.count("|") == 2:
+            _, cumulative, module = line.split("|")
+            if cumulative.strip().isdigit():
+                imports[module.strip()] = int(cumulative) / 1e6
+    total = imports.pop("main", 0)
+    return total, sorted(((seconds, module) for module, seconds in imports.items()), reverse=True)[:top]
+
+
+def time_to_ready(bulb_ip, cache_path):
+    started_at = perf_counter()
+    child = subprocess.Popen([sys.executable, __file__, "--child", bulb_ip, cache_path], cwd=HERE,
+                             stdout=subprocess.PIPE, text=True)
+    ready_at = None
+    for line in child.stdout:
+        if line.strip() == "READY":
+            ready_at = perf_counter()
+    child.wait()
+    return ready_at - started_at if ready_at else None
+
+
+async def run_child(bulb_ip, cache_path):
+    import main  # noqa: F401, the same imports as a real start
+    from device_cache import DeviceCache
+    from LightController import LightController
+
+    light_controller = LightController(bulb_ip, None, None)
+    light_controller.device_cache = DeviceCache(cache_path)
+    running = asyncio.create_task(light_controller.start())
+    while light_controller.controller_input is None and not running.done():
+        await asyncio.sleep(0.001)
+    print("READY", flush=True)
+    light_controller.stop()
+    await running
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure startup time against an emulated bulb")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--top", type=int, default=10, help="how many of the slowest imports to list")
+    parser.add_argument("--child", nargs=2, metavar=("BULB_IP", "CACHE_PATH"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        asyncio.run(run_child(*args.child))
+        return
+
+    import emulator
+
+    bulb_ip = emulator.start_bulbs_in_thread(1)[0].address
+    cache_path = os.path.join(tempfile.mkdtemp(), "device_cache.json")
+    times = [time_to_ready(bulb_ip, cache_path) for _ in range(args.runs)]
+    import_time, slowest_imports = profile_imports(args.top)
+
+    print("===============")
+    print(f"Imports: {import_time * 1000:.0f}ms")
+    for seconds, module in slowest_imports:
+        print(f"  {seconds * 1000:7.1f}ms  {module}")
+    if None in times:
+        print("The program did not get ready in every run")
+        return
+    print(f"Start to ready, empty device cache: {times[0] * 1000:.0f}ms")
+    if len(times) > 1:
+        print(f"Start to ready, cached devices: median {statistics.median(times[1:]) * 1000:.0f}ms - "
+              f"max {max(times[1:]) * 1000:.0f}ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -45,6 +45,9 @@ if platform_id == LINUX:
     LEFT_TRIGGER = 2
     RIGHT_TRIGGER = 5
 
+    # get_buttons() layout, None is always unpressed (Guide only works on Linux)
+    BUTTON_LAYOUT = (A, B, X, Y, LEFT_BUMP, RIGHT_BUMP, BACK, START, None, LEFT_STICK_BTN, RIGHT_STICK_BTN)
+
 elif platform_id == WINDOWS:
     # buttons
     A = 0
@@ -71,6 +74,9 @@ elif platform_id == WINDOWS:
         RIGHT_STICK_Y = 3
         TRIGGERS = 2
 
+    # get_buttons() layout
+    BUTTON_LAYOUT = (A, B, X, Y, LEFT_BUMP, RIGHT_BUMP, BACK, START, LEFT_STICK_BTN, RIGHT_STICK_BTN)
+
 elif platform_id == MAC:
     # buttons
     A = 11
@@ -98,6 +104,45 @@ elif platform_id == MAC:
     LEFT_TRIGGER = 4
     RIGHT_TRIGGER = 5
 
+    # get_buttons() layout, None is always unpressed
+    BUTTON_LAYOUT = (None, None, None, None, START, BACK, LEFT_STICK_BTN, RIGHT_STICK_BTN, LEFT_BUMP, RIGHT_BUMP, None,
+                     A, B, X, Y)
+
+# the inputs read by Controller.snapshot(), resolved once for this platform
+SNAPSHOT_BUTTONS = (A, B, X, Y, LEFT_BUMP, RIGHT_BUMP, BACK, START, LEFT_STICK_BTN, RIGHT_STICK_BTN)
+STICK_AXES = (LEFT_STICK_X, LEFT_STICK_Y, RIGHT_STICK_X, RIGHT_STICK_Y)
+PAD_BUTTONS = (PAD_UP, PAD_RIGHT, PAD_DOWN, PAD_LEFT) if platform_id == MAC else None
+
+
+class ControllerState:
+    """
+    The state of a controller at one point in time, as returned by
+    Controller.snapshot().
+
+    buttons follows the order of SNAPSHOT_BUTTONS, the sticks are dead zone
+    adjusted (x, y) tuples, triggers is the value of Controller.get_triggers()
+    and pad is (up, right, down, left).
+    """
+
+    __slots__ = ("buttons", "left_stick", "right_stick", "triggers", "pad")
+
+    def __init__(self, buttons, left_stick, right_stick, triggers, pad):
+        self.buttons = buttons
+        self.left_stick = left_stick
+        self.right_stick = right_stick
+        self.triggers = triggers
+        self.pad = pad
+
+    def changes(self, previous):
+        """
+        Returns:
+            A dict of the inputs (by attribute name) that differ from the previous
+            snapshot, or of all inputs when previous is None.
+        """
+
+        return {name: getattr(self, name) for name in self.__slots__
+                if previous is None or getattr(self, name) != getattr(previous, name)}
+
 
 class Controller:
     def __init__(self, device_id, dead_zone=0.15):
@@ -116,6 +161,10 @@ class Controller:
         self.left_trigger_used = False
         self.right_trigger_used = False
 
+        # snapshot() only redoes the dead zone adjustment when the raw axes moved
+        self.last_axes = None
+        self.last_sticks = None
+
     def get_id(self):
         """
         Returns:
@@ -151,47 +200,7 @@ class Controller:
             A tuple with the state of each button. 1 is pressed, 0 is unpressed.
         """
 
-        if platform_id == LINUX:
-            return (self.joystick.get_button(A),
-                    self.joystick.get_button(B),
-                    self.joystick.get_button(X),
-                    self.joystick.get_button(Y),
-                    self.joystick.get_button(LEFT_BUMP),
-                    self.joystick.get_button(RIGHT_BUMP),
-                    self.joystick.get_button(BACK),
-                    self.joystick.get_button(START),
-                    0,  # Unused, since Guide only works on Linux
-                    self.joystick.get_button(LEFT_STICK_BTN),
-                    self.joystick.get_button(RIGHT_STICK_BTN))
-
-        elif platform_id == WINDOWS:
-            return (self.joystick.get_button(A),
-                    self.joystick.get_button(B),
-                    self.joystick.get_button(X),
-                    self.joystick.get_button(Y),
-                    self.joystick.get_button(LEFT_BUMP),
-                    self.joystick.get_button(RIGHT_BUMP),
-                    self.joystick.get_button(BACK),
-                    self.joystick.get_button(START),
-                    self.joystick.get_button(LEFT_STICK_BTN),
-                    self.joystick.get_button(RIGHT_STICK_BTN))
-
-        elif platform_id == MAC:
-            return (0,  # Unused
-                    0,  # Unused
-                    0,  # Unused
-                    0,  # Unused
-                    self.joystick.get_button(START),
-                    self.joystick.get_button(BACK),
-                    self.joystick.get_button(LEFT_STICK_BTN),
-                    self.joystick.get_button(RIGHT_STICK_BTN),
-                    self.joystick.get_button(LEFT_BUMP),
-                    self.joystick.get_button(RIGHT_BUMP),
-                    0,  # Unused
-                    self.joystick.get_button(A),
-                    self.joystick.get_button(B),
-                    self.joystick.get_button(X),
-                    self.joystick.get_button(Y))
+        return tuple(0 if button is None else self.joystick.get_button(button) for button in BUTTON_LAYOUT)
 
     def get_left_stick(self):
         """
@@ -229,7 +238,7 @@ class Controller:
 
         return (right_stick_x, right_stick_y)
 
-    def get_triggers(self):
+    def get_tracked_triggers(self):
         """
         Gets the state of the triggers.
 
@@ -249,35 +258,38 @@ class Controller:
             simultaneously, then the sum of the trigger pulls is returned.
         """
 
-        trigger_axis = 0.0
+        left = self.joystick.get_axis(LEFT_TRIGGER)
+        right = self.joystick.get_axis(RIGHT_TRIGGER)
 
-        if platform_id == LINUX or platform_id == MAC:
-            left = self.joystick.get_axis(LEFT_TRIGGER)
-            right = self.joystick.get_axis(RIGHT_TRIGGER)
+        if left != 0:
+            self.left_trigger_used = True
+        if right != 0:
+            self.right_trigger_used = True
 
-            if left != 0:
-                self.left_trigger_used = True
-            if right != 0:
-                self.right_trigger_used = True
+        if not self.left_trigger_used:
+            left = -1
+        if not self.right_trigger_used:
+            right = -1
 
-            if not self.left_trigger_used:
-                left = -1
-            if not self.right_trigger_used:
-                right = -1
+        return (-1 * left + right) / 2
 
-            trigger_axis = (-1 * left + right) / 2
+    def get_separate_triggers(self):
+        """
+        get_triggers() on Windows with pygame 2.
+        """
 
-        elif platform_id == WINDOWS:
-            if version == 2:
-                left = self.joystick.get_axis(LEFT_TRIGGER)
-                right = self.joystick.get_axis(RIGHT_TRIGGER)
-                trigger_axis = (-1 * left + right) / 2
-            else:
-                trigger_axis = -1 * self.joystick.get_axis(TRIGGERS)
+        left = self.joystick.get_axis(LEFT_TRIGGER)
+        right = self.joystick.get_axis(RIGHT_TRIGGER)
+        return (-1 * left + right) / 2
 
-        return trigger_axis
+    def get_shared_trigger(self):
+        """
+        get_triggers() on Windows with pygame 1.9.
+        """
 
-    def get_pad(self):
+        return -1 * self.joystick.get_axis(TRIGGERS)
+
+    def get_hat_pad(self):
         """
         Gets the state of the directional pad.
 
@@ -287,18 +299,37 @@ class Controller:
             to have up to two 1s in the returned tuple.
         """
 
-        if platform_id == LINUX or platform_id == WINDOWS:
-            hat_x, hat_y = self.joystick.get_hat(0)
+        hat_x, hat_y = self.joystick.get_hat(0)
+        return int(hat_y == 1), int(hat_x == 1), int(hat_y == -1), int(hat_x == -1)
+
+    def get_button_pad(self):
+        """
+        get_pad() on Mac, where the pad is four buttons.
+        """
+
+        return tuple(self.joystick.get_button(button) for button in PAD_BUTTONS)
 
-            up = int(hat_y == 1)
-            right = int(hat_x == 1)
-            down = int(hat_y == -1)
-            left = int(hat_x == -1)
+    # the platform is known at import time, so the variant is picked once instead of on every call
+    if platform_id == WINDOWS:
+        get_triggers = get_separate_triggers if version == 2 else get_shared_trigger
+    else:
+        get_triggers = get_tracked_triggers
+    get_pad = get_hat_pad if PAD_BUTTONS is None else get_button_pad
 
-        elif platform_id == MAC:
-            up = self.joystick.get_button(PAD_UP)
-            right = self.joystick.get_button(PAD_RIGHT)
-            down = self.joystick.get_button(PAD_DOWN)
-            left = self.joystick.get_button(PAD_LEFT)
+    def snapshot(self):
+        """
+        Reads all buttons, sticks, the triggers and the pad in one pass.
+
+        Returns:
+            A ControllerState. Use its changes() with the previous snapshot to get
+            only the inputs that changed.
+        """
 
-        return up, right, down, left
\ No newline at end of file
+        joystick = self.joystick
+        buttons = tuple(joystick.get_button(button) for button in SNAPSHOT_BUTTONS)
+        axes = tuple(joystick.get_axis(axis) for axis in STICK_AXES)
+        if axes != self.last_axes:
+            self.last_axes = axes
+            self.last_sticks = tuple(self.dead_zone_adjustment(value) for value in axes)
+        left_x, left_y, right_x, right_y = self.last_sticks
+        return ControllerState(buttons, (left_x, left_y), (right_x, right_y), self.get_triggers(), self.get_pad())